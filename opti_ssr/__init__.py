@@ -1,3 +1,3 @@
 from .ssr_client import SSRClient
 from .opti_client import OptiTrackClient
-from .bridges import HeadTracker, LocalWFS
+from .bridges import HeadTracker, LocalWFS, Dispatcher, SendPolicy
@@ -0,0 +1,145 @@
+"""
+A python module to receive data from the Optitrack optical tracking system
+with asyncio, such that a single event loop can serve many consumers
+without a thread per connection.
+
+This module requires Python 3.6 or newer.
+"""
+
+import asyncio
+
+from . import optirx as rx
+from .opti_client import rigid_body_data
+
+
+class _DataProtocol(asyncio.DatagramProtocol):
+    """Forward the datagrams of the data socket to an AsyncOptiTrackClient."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def datagram_received(self, data, addr):
+        self._client._datagram_received(data)
+
+    def error_received(self, exc):
+        # errors of single datagrams do not end the stream
+        pass
+
+    def connection_lost(self, exc):
+        self._client._connection_lost(exc)
+
+
+class AsyncOptiTrackClient:
+    """
+    Receive data from Optitrack systems and Motive software on an asyncio
+    event loop. By default, it connects to Optitrack software Motive on
+    the same machine.
+
+    Every received frame is decoded once, and only if somebody waits for it,
+    and is handed to all waiting consumers. Frames arriving while no consumer
+    is waiting are dropped, such that consumers always get the newest frame.
+
+    Example::
+
+        client = AsyncOptiTrackClient()
+        await client.connect()
+        async for frame in client.frames():
+            ...
+
+    Attributes
+    ----------
+    unicast_ip : str, optional
+        IP of the Motive software to establish a unicast connection to,
+        which is kept alive until the client is closed.
+        By default, no unicast connection is established.
+    multicast_ip : str, optional
+        Multicast address to connect to.
+    port : int, optional
+        Port of the Motive network interface.
+    natnet_version : tuple, optional
+        Version number of the NatNetSDK to use.
+    fields : list, optional
+        Names of the FrameOfData fields to decode. By default, all fields are decoded.
+    """
+
+    def __init__(self, unicast_ip=None, multicast_ip="239.255.42.99", port=1511,
+                 natnet_version=(3, 0, 0, 0), fields=None):
+        self._unicast_ip = unicast_ip
+        self._multicast_ip = multicast_ip
+        self._port = port
+        self._natnet_version = natnet_version
+        self._unpack = rx.mkunpacker(natnet_version, fields)
+        self._loop = None
+        self._transport = None
+        self._keepalive = None
+        self._waiters = []
+
+    async def connect(self):
+        """
+        Create the data socket and attach it to the running event loop.
+        """
+        self._loop = asyncio.get_event_loop()
+        dsock = rx.mkdatasock(ip_address=self._unicast_ip,
+                              multicast_address=self._multicast_ip,
+                              port=self._port)
+        self._transport, _ = await self._loop.create_datagram_endpoint(
+            lambda: _DataProtocol(self), sock=dsock)
+        if self._unicast_ip:
+            self._keepalive = rx.KeepAlive(dsock, self._unicast_ip, version=self._natnet_version)
+            self._keepalive.start()
+
+    def close(self):
+        """
+        Close the data socket. Waiting consumers get a ConnectionError.
+        """
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+            self._keepalive = None
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    def next_frame(self):
+        """
+        Return a future resolving to the next received FrameOfData.
+        """
+        if self._transport is None:
+            raise ConnectionError("AsyncOptiTrackClient is not connected")
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        return waiter
+
+    async def frames(self):
+        """
+        Asynchronously iterate over the received frames.
+        """
+        while True:
+            yield await self.next_frame()
+
+    async def get_rigid_body(self, rb_id=0):
+        """
+        Wait for the next frame and return rigid body position,
+        orientation and time data as OptiTrackClient.get_rigid_body does.
+        """
+        return rigid_body_data(await self.next_frame(), rb_id)
+
+    def _datagram_received(self, data):
+        if not self._waiters or rx.peek_msgtype(data) != rx.NAT_FRAMEOFDATA:
+            return
+        waiters, self._waiters = self._waiters, []
+        try:
+            frame = self._unpack(data)
+        except Exception as exc:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(exc)
+            return
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(frame)
+
+    def _connection_lost(self, exc):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(exc or ConnectionError("data socket closed"))
@@ -7,31 +7,197 @@ _Bridge is a thread class that includes the actual sequence, whereas the subclas
 different applications of a connection between the SSR and a tracking system.
 In any subclass of _Bridge the functions to receive and send data need to be defined
 according to the desired application.
+
+Several bridges can share one connection to the OptiTrack system through a Dispatcher,
+which receives and decodes every frame once and feeds it to all subscribed bridges.
 """
 
 from __future__ import print_function
 import sys
 import threading
 import socket
-from time import sleep
+from time import sleep, time
 from abc import ABCMeta, abstractmethod # for abstract classes and methods
 import numpy as np
+try:
+    import selectors
+except ImportError:  # Python 2, the bridges poll instead
+    selectors = None
+
+from . import optirx as rx
+from .opti_client import rigid_body_data
+from .history import PoseHistory
+from .pipeline import Calibration, head_azimuth
+
+class SendPolicy(object):
+    """
+    Decide which updates the bridges send to the SSR.
+
+    An update of a target, e.g. the reference orientation, is suppressed if
+    it differs less than a deadband from the last value sent to the target,
+    or if the last update of the target was sent less than 1 / max_rate
+    seconds ago. Updates from frames in which the rigid body was not
+    tracked are suppressed as a whole.
+
+    The numbers of sent and suppressed messages per target are counted in
+    the dictionaries `sent` and `suppressed`, the number of suppressed
+    frames in `invalid_frames`. By default, nothing is suppressed.
+
+    Attributes
+    ----------
+    min_angle : float, optional
+        Angular deadband in degrees.
+    min_distance : float, optional
+        Positional deadband in meters.
+    max_rate : float, optional
+        Maximum number of updates per second and target.
+    skip_invalid : bool, optional
+        Suppress frames in which the rigid body was not tracked.
+    clock : function, optional
+        Function returning the current time in seconds.
+    """
 
-from .opti_client import Quaternion
+    def __init__(self, min_angle=0, min_distance=0, max_rate=None, skip_invalid=False, clock=time):
+        self.min_angle = min_angle
+        self.min_distance = min_distance
+        self.max_rate = max_rate
+        self.skip_invalid = skip_invalid
+        self._clock = clock
+        # target -> last sent value, time it was sent
+        self._last_value = {}
+        self._last_time = {}
+        self.reset_counts()
+
+    def reset_counts(self):
+        """Reset the numbers of sent and suppressed messages."""
+        self.sent = {}
+        self.suppressed = {}
+        self.invalid_frames = 0
+
+    def accept_frame(self, tracking_valid):
+        """Return whether to send the updates of a frame."""
+        if self.skip_invalid and tracking_valid is False:
+            self.invalid_frames += 1
+            return False
+        return True
+
+    def angle(self, target, angle, messages=1):
+        """Return whether to send an angle in degrees to a target."""
+        last = self._last_value.get(target)
+        if last is not None and self.min_angle:
+            # shortest difference on the circle
+            if abs((angle - last + 180) % 360 - 180) < self.min_angle:
+                return self._suppress(target, messages)
+        return self._rate_limit(target, angle, messages)
+
+    def position(self, target, position, messages=1):
+        """Return whether to send a position in meters to a target."""
+        last = self._last_value.get(target)
+        if last is not None and self.min_distance:
+            if np.linalg.norm(np.subtract(position, last)) < self.min_distance:
+                return self._suppress(target, messages)
+        return self._rate_limit(target, np.array(position), messages)
+
+    def _rate_limit(self, target, value, messages):
+        now = self._clock()
+        if self.max_rate:
+            last_time = self._last_time.get(target)
+            if last_time is not None and now - last_time < 1.0 / self.max_rate:
+                return self._suppress(target, messages)
+        self._last_value[target] = value
+        self._last_time[target] = now
+        self.sent[target] = self.sent.get(target, 0) + messages
+        return True
+
+    def _suppress(self, target, messages):
+        self.suppressed[target] = self.suppressed.get(target, 0) + messages
+        return False
+
+class _SelectLoop(object):
+    """Wait on the socket of the OptiTrack client and the sockets of SSR
+       clients without a reader thread with a selector.
+
+       Classes using it define the attributes _optitrack and _quit
+       (a threading.Event) and call _select from their run method.
+    """
+
+    _wake_send = None  # wakes the selector, while _select runs
+
+    def _select(self, receive, ssr_clients):
+        """Call `receive` when the OptiTrack client is readable and read the
+           messages of the SSR clients returned by `ssr_clients`, which is
+           called again after every wakeup, until _quit is set.
+        """
+        selector = selectors.DefaultSelector()
+        wake_recv, wake_send = socket.socketpair()
+        wake_recv.setblocking(False)
+        wake_send.setblocking(False)
+        self._wake_send = wake_send
+        selector.register(wake_recv, selectors.EVENT_READ, wake_recv)
+        selector.register(self._optitrack, selectors.EVENT_READ, self._optitrack)
+        registered = set()  # SSR clients waited on
+        closed = set()  # SSR clients whose connection was closed by the SSR
+        try:
+            while not self._quit.is_set():
+                # SSR clients with a reader thread or without a socket are skipped
+                wanted = set(ssr for ssr in ssr_clients()
+                             if getattr(ssr, 'reader', True) is None and ssr not in closed)
+                for ssr in wanted - registered:
+                    selector.register(ssr, selectors.EVENT_READ, ssr)
+                for ssr in registered - wanted:
+                    selector.unregister(ssr)
+                registered = wanted
+                for key, _ in selector.select():
+                    if key.data is self._optitrack:
+                        receive()
+                    elif key.data is wake_recv:
+                        try:
+                            wake_recv.recv(4096)
+                        except socket.error:
+                            pass
+                    elif key.data.recv_ssr_returns() is False:
+                        # closed by the SSR, the socket would stay readable
+                        selector.unregister(key.fileobj)
+                        registered.discard(key.data)
+                        closed.add(key.data)
+        except (KeyboardInterrupt, SystemExit):
+            self._quit.set()
+        finally:
+            selector.close()
+            self._wake_send = None
+            wake_send.close()
+            wake_recv.close()
+
+    def _wake(self):
+        wake_send = self._wake_send
+        if wake_send is not None:
+            try:
+                wake_send.send(b'\0')
+            except socket.error:
+                pass  # woken already or _select has just ended
 
-class _Bridge(threading.Thread):
+class _Bridge(_SelectLoop, threading.Thread):
     """An abstract class which implements a threading approach to receive and send data.
        To implement the functionality to send and receive the desired data,
        subclasses need to define the functions _receive and _send.
 
        .. note:: The returns of _receive have to be the input of _send.
+
+       Which updates are sent to the SSR is decided by a SendPolicy,
+       passed as keyword argument `policy`.
+
+       The thread waits on the socket of the OptiTrack client and the
+       sockets of SSR clients without a reader thread with a selector,
+       such that a frame is processed as soon as it arrives. Without
+       selectors (Python 2) or a socket of the OptiTrack client, it polls
+       and sleeps `timeout` seconds after a socket error.
     """
 
     # Python2 compatible way to declare an abstract class
     __metaclass__ = ABCMeta
 
     def __init__(
-            self, optitrack, ssr, data_limit=500, timeout=0.01, *args,
+            self, optitrack, ssr, data_limit=500, timeout=0.01, policy=None, *args,
             **kwargs):
 
         # call contructor of super class (threading.Thread)
@@ -45,28 +211,52 @@ class _Bridge(threading.Thread):
         self._ssr = ssr
 
         # storing older data
-        self._data = []  # the data buffer itself
-        self._data_limit = data_limit  # maximum number of entries
-        self._data_lock = threading.Lock()  # mutex to block access
+        self._history = PoseHistory(data_limit)  # ring buffer of the last poses
         self._data_available = threading.Event()  # event for new data
 
         # timeout
         self._timeout = timeout  # timeout in seconds
+        # the SSR replies are read by run() itself
+        self._draining = False
+
+        # deadbands, rate limits and counters of the updates sent to the SSR
+        self._policy = SendPolicy() if policy is None else policy
+
+    @property
+    def policy(self):
+        """SendPolicy of the bridge."""
+        return self._policy
 
     def get_last_data(self, num=None):
-        """Returns a list of data received from the OptiTrack system."""
-        if not num:
-            num = self._data_limit
-        return self._data[-num:]
+        """Returns the last poses received from the OptiTrack system
+           as an array of history.POSE_DTYPE, all kept poses by default.
+           The poses of a HeadTracker are in its calibrated coordinate system."""
+        return self._history.get_last(num or None)
+
+    def get_range(self, t0, t1):
+        """Returns the received poses with t0 <= timestamp < t1."""
+        return self._history.get_range(t0, t1)
+
+    def get_since(self, frameno):
+        """Returns the poses received after frame number frameno."""
+        return self._history.get_since(frameno)
 
     def clear_data(self):
         """Clears buffer"""
-        if self._data_available.is_set():
-            with self._data_lock:  # lock the mutex
-                self._data = []
-                self._data_available.clear()
+        self._history.clear()
+        self._data_available.clear()
 
     def run(self):
+        if selectors is None or not hasattr(self._optitrack, 'fileno'):
+            self._poll()
+            return
+        self._draining = True
+        try:
+            self._select(self._receive_and_handle, self._ssr_clients)
+        finally:
+            self._draining = False
+
+    def _poll(self):
         while not self._quit.is_set():
             try:
                 packet = self._receive()
@@ -75,16 +265,73 @@ class _Bridge(threading.Thread):
             except (KeyboardInterrupt, SystemExit):
                 self._quit.set()
             else:
-                # save data
-                with self._data_lock:
-                    self._data.append(packet)
-                    self._data = self._data[-self._data_limit:]
-                self._data_available.set()
-                # send data
-                self._send(packet)
+                self._handle(packet, getattr(self._optitrack, 'tracking_valid', None))
+
+    def _receive_and_handle(self):
+        try:
+            packet = self._receive()
+        except socket.error:
+            return
+        self._handle(packet, getattr(self._optitrack, 'tracking_valid', None))
+
+    def _handle(self, packet, tracking_valid=None):
+        # send data, all messages of a packet at once in batch mode
+        if self._policy.accept_frame(tracking_valid):
+            self._send(packet)
+            self._flush_ssr()
+
+    def feed(self, pose, tracking_valid=None):
+        """Process a rigid body pose received by a Dispatcher.
+
+        Parameters
+        ----------
+        pose : tuple
+            Position, orientation and time data as returned by
+            OptiTrackClient.get_rigid_body.
+        tracking_valid : bool, optional
+            Whether the rigid body was tracked, None if unknown.
+        """
+        # the SSR replies are read by the Dispatcher, not here, such
+        # that a quiet SSR does not block the other bridges
+        self._handle(self._process(pose), tracking_valid)
 
     def stop(self):
         self._quit.set()  # fire event to stop execution
+        self._wake()
+
+    def _ssr_clients(self):
+        """Return the SSR clients the bridge sends to."""
+        return [self._ssr]
+
+    def _recv_ssr_returns(self):
+        if self._draining:
+            return  # read by run() when they arrive
+        for ssr in self._ssr_clients():
+            ssr.recv_ssr_returns()
+
+    def _flush_ssr(self):
+        for ssr in self._ssr_clients():
+            ssr.flush()
+
+    def _process(self, pose):
+        """Save a rigid body pose and return the input of _send for it."""
+        pose = self._to_world(pose)
+        self._history.append(pose)
+        self._data_available.set()
+        return self._transform(pose)
+
+    def _to_world(self, pose):
+        """Return a rigid body pose in the coordinate system of the bridge,
+           in which it is kept in the history. By default, Motive's.
+        """
+        return pose
+
+    def _transform(self, pose):
+        """Turn a rigid body pose into the input of _send.
+           Subclasses define it to be fed by a Dispatcher.
+        """
+        raise NotImplementedError(
+            "{} cannot be fed by a Dispatcher".format(type(self).__name__))
 
     @abstractmethod
     def _receive(self):
@@ -104,8 +351,9 @@ class HeadTracker(_Bridge):
         Object of class OptiTrackClient.
     ssr : class object
         Object of class SSRClient.
-    rb_id : int, optional
-        ID of the rigid body to receive data from.
+    rb_id : int or str, optional
+        ID or name of the rigid body to receive data from,
+        see OptiTrackClient.rigid_body_index.
     angle : int, optional
         angle which is used for head rotation
         
@@ -124,29 +372,35 @@ class HeadTracker(_Bridge):
         self._rb_id = rb_id
         self._angle = angle
         # origin and orientation of world coordinate system
-        self._origin = np.array((0, 0, 0))
-        self._orientation = Quaternion(1, 0, 0, 0)
+        self._calibration = Calibration()
 
     def calibrate(self):
         """
         Use current position and orientation of head tracker to set the origin
         and orientation of the world coordinate system.
         """
-        self._origin, self._orientation, _ = self._optitrack.get_rigid_body(self._rb_id)
+        position, orientation, _ = self._optitrack.get_rigid_body(self._rb_id)
+        self._calibration.calibrate(position, orientation)
 
     def _receive(self):
-        self._ssr.recv_ssr_returns()
-        pos, ori, time_data = self._optitrack.get_rigid_body(self._rb_id)
+        self._recv_ssr_returns()
+        return self._process(self._optitrack.get_rigid_body(self._rb_id))
+
+    def _to_world(self, pose):
+        pos, ori, time_data = pose
         # apply coordinate transform
-        pos = pos - self._origin
-        ori = self._orientation.conjugate * ori  # not commutative
+        pos, ori = self._calibration.apply(pos, ori)
+        return pos, ori, time_data
 
+    def _transform(self, pose):
+        pos, ori, time_data = pose
         return pos, ori.yaw_pitch_roll, time_data
 
     def _send(self, data):
         _, ypr, _ = data  # (pos, ypr, time_data)
-        alpha = np.sign(self._angle)*ypr[np.absolute(self._angle)-1]*180/np.pi+90
-        self._ssr.set_ref_orientation(alpha)
+        alpha = head_azimuth(ypr, self._angle)
+        if self._policy.angle('ref_orientation', alpha):
+            self._ssr.set_ref_orientation(alpha)
 
 class LocalWFS(_Bridge):
     """
@@ -170,8 +424,9 @@ class LocalWFS(_Bridge):
         First SSR instance as object of class SSRClient.
     ssr_virt_repr : class object
         Second SSR instance as object of the class SSRClient.
-    rb_id : int, optional
-        ID of the rigid body to receive data from.
+    rb_id : int or str, optional
+        ID or name of the rigid body to receive data from,
+        see OptiTrackClient.rigid_body_index.
     """
     def __init__(self, optitrack, ssr, ssr_virt_repr, rb_id=0, *args, **kwargs):
         # call contructor of super class
@@ -201,16 +456,145 @@ class LocalWFS(_Bridge):
             Rigid body position data.
             Consists of x, y, z coordinates of Motive`s coordinate system.
         """
-        self._ssr.recv_ssr_returns()
-        self._ssr_virt_repr.recv_ssr_returns()
+        self._recv_ssr_returns()
+        return self._process(self._optitrack.get_rigid_body(self._rb_id))
 
-        center, _, _ = self._optitrack.get_rigid_body()
+    def _ssr_clients(self):
+        return [self._ssr, self._ssr_virt_repr]
 
+    def _transform(self, pose):
+        center, _, _ = pose
         return center
 
     def _send(self, center):
         """Send reference position data to both SSR instance.
         """
+        if not self._policy.position('ref_position', center[:2], messages=3):
+            return
         self._ssr.set_ref_position(-center[0], -center[1])
         self._ssr.set_ref_offset_position(center[0], center[1])
         self._ssr_virt_repr.set_ref_position(center[0], center[1])
+
+class Dispatcher(_SelectLoop, threading.Thread):
+    """
+    A thread which receives frames from a single OptiTrack connection
+    and feeds them to many bridges.
+
+    Every frame is received and decoded once, and the pose of every
+    subscribed rigid body is extracted once, however many bridges
+    subscribed to it. The bridges are fed in the thread of the dispatcher
+    and are not started themselves.
+
+    The dispatcher waits on the socket of the OptiTrack client and the
+    sockets of the SSR clients of the bridges without a reader thread
+    with a selector, and reads the messages returned by the SSR when they
+    arrive. Without selectors (Python 2) or a socket of the OptiTrack
+    client, it polls, and the SSR clients should have a reader thread.
+
+    A subscription whose rigid body is not in a frame is skipped for
+    that frame; the number of skipped frames per rigid body is counted
+    in the dictionary `skipped`.
+
+    Attributes
+    ----------
+    optitrack : class object
+        Object of class OptiTrackClient.
+    timeout : float, optional
+        Time in seconds to wait after a socket error.
+    """
+
+    def __init__(self, optitrack, timeout=0.01, *args, **kwargs):
+        # call contructor of super class (threading.Thread)
+        super(Dispatcher, self).__init__(*args, **kwargs)
+        self._quit = threading.Event()
+        self._optitrack = optitrack
+        self._timeout = timeout
+        # rigid body id -> subscribed bridges
+        self._subscriptions = {}
+        self._subscriptions_lock = threading.Lock()
+        # rigid body id -> number of frames it was missing from
+        self.skipped = {}
+
+    def subscribe(self, bridge, rb_id=None):
+        """Feed a bridge with the poses of a rigid body.
+
+        Parameters
+        ----------
+        bridge : class object
+            Object of a subclass of _Bridge.
+        rb_id : int or str, optional
+            ID or name of the rigid body. By default, the rigid body of the bridge.
+        """
+        if rb_id is None:
+            rb_id = bridge._rb_id
+        with self._subscriptions_lock:
+            bridges = self._subscriptions.get(rb_id, ())
+            if bridge not in bridges:
+                # replaced, not appended to, while run() may iterate over it
+                self._subscriptions[rb_id] = bridges + (bridge,)
+        self._wake()
+
+    def unsubscribe(self, bridge):
+        """Stop feeding a bridge."""
+        with self._subscriptions_lock:
+            for rb_id, bridges in list(self._subscriptions.items()):
+                bridges = tuple(b for b in bridges if b is not bridge)
+                if bridges:
+                    self._subscriptions[rb_id] = bridges
+                else:
+                    del self._subscriptions[rb_id]
+        self._wake()
+
+    def run(self):
+        if selectors is None or not hasattr(self._optitrack, 'fileno'):
+            self._poll()
+            return
+        self._select(self._receive_and_dispatch, self._subscribed_ssr_clients)
+
+    def _subscribed_ssr_clients(self):
+        """Return the SSR clients of the subscribed bridges."""
+        with self._subscriptions_lock:
+            subscriptions = list(self._subscriptions.values())
+        return [ssr for bridges in subscriptions for bridge in bridges
+                for ssr in bridge._ssr_clients()]
+
+    def _poll(self):
+        while not self._quit.is_set():
+            try:
+                frame = self._receive()
+            except socket.error:
+                sleep(self._timeout)
+            except (KeyboardInterrupt, SystemExit):
+                self._quit.set()
+            else:
+                self._dispatch(frame)
+
+    def _receive(self):
+        # only the rigid bodies and the frame trailer are decoded
+        return self._optitrack.get_packet_data([rx.FrameOfData], fields=("rigid_bodies",))
+
+    def _receive_and_dispatch(self):
+        try:
+            frame = self._receive()
+        except socket.error:
+            return
+        self._dispatch(frame)
+
+    def _dispatch(self, frame):
+        with self._subscriptions_lock:
+            subscriptions = list(self._subscriptions.items())
+        for rb_id, bridges in subscriptions:
+            try:
+                index = self._optitrack.rigid_body_index(frame, rb_id)
+                pose = rigid_body_data(frame, index)
+            except LookupError:  # IndexError or KeyError
+                # the rigid body is not in the frame, the others are fed on
+                self.skipped[rb_id] = self.skipped.get(rb_id, 0) + 1
+                continue
+            tracking_valid = frame.rigid_bodies[index].tracking_valid
+            for bridge in bridges:
+                bridge.feed(pose, tracking_valid)
+
+    def stop(self):
+        self._quit.set()  # fire event to stop execution
+        self._wake()
@@ -0,0 +1,97 @@
+"""
+A python module to keep the recent tracking data of a rigid body
+in a preallocated NumPy ring buffer.
+
+Appending a pose overwrites the oldest one once the buffer is full and
+costs the same however long the history is. The queries return
+consistent copies of the requested poses in chronological order, taken
+while the writer is locked out for the duration of the copy only.
+"""
+
+import threading
+import numpy as np
+
+# orientation is the quaternion (w, x, y, z),
+# latency is NaN if the NatNet version does not send it
+POSE_DTYPE = np.dtype([("frameno", "i4"),
+                       ("timestamp", "f8"),
+                       ("latency", "f8"),
+                       ("position", "f8", (3,)),
+                       ("orientation", "f8", (4,))])
+
+
+class PoseHistory(object):
+    """
+    Ring buffer of the last `size` poses of a rigid body.
+
+    Attributes
+    ----------
+    size : int, optional
+        Maximum number of poses kept.
+    """
+
+    def __init__(self, size=500):
+        self._buf = np.zeros(size, POSE_DTYPE)
+        self._size = size
+        self._count = 0  # number of poses appended since the last clear
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, self._size)
+
+    def append(self, pose):
+        """
+        Append a pose, i.e. position, orientation and time data as returned
+        by OptiTrackClient.get_rigid_body.
+        """
+        position, orientation, (frameno, timestamp, latency) = pose
+        with self._lock:
+            row = self._buf[self._count % self._size]
+            row["frameno"] = frameno
+            row["timestamp"] = np.nan if timestamp is None else timestamp
+            row["latency"] = np.nan if latency is None else latency
+            row["position"] = position
+            row["orientation"] = orientation.q
+            self._count += 1
+
+    def clear(self):
+        """Remove all poses."""
+        with self._lock:
+            self._count = 0
+
+    def _order(self):
+        """Indices of the kept poses in chronological order, the lock has to be held."""
+        num = min(self._count, self._size)
+        return np.arange(self._count - num, self._count) % self._size
+
+    def get_last(self, num=None):
+        """
+        Return a copy of the last `num` poses, all kept poses by default,
+        as a POSE_DTYPE array.
+        """
+        with self._lock:
+            index = self._order()
+            if num is not None:
+                index = index[len(index) - min(num, len(index)):]
+            return self._buf[index]
+
+    def get_range(self, t0, t1):
+        """
+        Return a copy of the poses with t0 <= timestamp < t1.
+        """
+        with self._lock:
+            index = self._order()
+            # the timestamps increase from frame to frame
+            timestamps = self._buf["timestamp"][index]
+            start, stop = np.searchsorted(timestamps, [t0, t1])
+            return self._buf[index[start:stop]]
+
+    def get_since(self, frameno):
+        """
+        Return a copy of the poses of the frames after frame number `frameno`.
+        """
+        with self._lock:
+            index = self._order()
+            framenos = self._buf["frameno"][index]
+            start = np.searchsorted(framenos, frameno, side="right")
+            return self._buf[index[start:]]
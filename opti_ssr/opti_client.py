@@ -3,10 +3,14 @@ A python module to connect to Optitrack optical tracking system
 and receive data from it.
 """
 
+import socket
+from time import time
 import numpy as np
 import pyquaternion  # for handling quaternions
 from . import optirx as rx
 
+_FRAMEOFDATA = frozenset([rx.NAT_FRAMEOFDATA])
+
 class OptiTrackClient:
     """
     Connect to Optitrack systems and Motive software and receive data,
@@ -17,20 +21,132 @@ class OptiTrackClient:
     ----------
     unicast_ip : str, optional
         IP of the Motive software to establish a unicast connection to.
-        By default, no unicast connection is established.
+        The client registers with Motive over its command port and keeps
+        the registration alive until it is closed.
+        By default, no unicast connection is established and the client
+        joins the multicast group.
     multicast_ip : str, optional
         Multicast address to connect to.
     port : int, optional
         Port of the Motive network interface.
     natnet_version : tuple, optional
         Version number of the NatNetSDK to use.
+        If None, the version is requested from Motive once at connect time.
+    reuse : bool, optional
+        If True, get_rigid_body decodes every frame into the same
+        preallocated records and returns the same position array and
+        orientation quaternion, overwritten in place, on every call.
+        Copy them to keep the values of a frame.
+    latest_only : bool, optional
+        If True, every call reads all packets queued on the socket and
+        decodes only the newest one, such that the returned data never
+        lags behind when the caller is slower than the frame rate.
+        The number of skipped packets is reported by `skipped_frames`
+        and `last_skipped_frames`.
+    index_by_id : bool, optional
+        If True, the rb_id of get_rigid_body is the rigid body ID of Motive
+        instead of the position in the rigid body table of the frames.
+        Rigid bodies can always be selected by their name.
+    server_ip : str, optional
+        IP of the Motive software to send commands to, i.e. the version
+        request and the request of the model definitions, e.g. the host
+        streaming to the multicast group. By default, unicast_ip, or else
+        Motive on the same machine.
     """
 
-    def __init__(self, unicast_ip=None, multicast_ip="239.255.42.99", port=1511, natnet_version=(3, 0, 0, 0)):
+    def __init__(self, unicast_ip=None, multicast_ip="239.255.42.99", port=1511, natnet_version=(3, 0, 0, 0), reuse=False, latest_only=False, index_by_id=False, server_ip=None):
         self._dsock = rx.mkdatasock(ip_address=unicast_ip, multicast_address=multicast_ip, port=port)
+        if server_ip is None:
+            server_ip = unicast_ip
+        if natnet_version is None:
+            natnet_version = self._detect_natnet_version(server_ip)
         self._natnet_version = natnet_version
+        # keep the unicast registration with Motive alive
+        if unicast_ip:
+            self._keepalive = rx.KeepAlive(self._dsock, unicast_ip, version=natnet_version)
+            self._keepalive.start()
+        else:
+            self._keepalive = None
+        # decoders specialized for the NatNet version of the server
+        self._unpack = rx.mkunpacker(natnet_version)
+        self._unpack_rigid_bodies = rx.mkunpacker(natnet_version, fields=("rigid_bodies",))
+        # preallocated receive buffers
+        self._buffers = rx.BufferPool()
+        # drain the socket and only decode the newest packet
+        self._latest_only = latest_only
+        self._skipped_frames = 0
+        self._last_skipped_frames = 0
+        # preallocated frame, position and orientation for the reuse mode
+        if reuse:
+            self._frame = rx.FrameRecord()
+            self._unpack_into = rx.mkrecordunpacker(natnet_version)
+            self._position = np.zeros(3)
+            self._orientation = Quaternion()
+        else:
+            self._frame = None
+        # validity of the last rigid body returned by get_rigid_body
+        self._tracking_valid = None
+        # model definitions, fetched on the first lookup by ID or name
+        self._index_by_id = index_by_id
+        self._models = ModelCache(server_ip, natnet_version)
+
+    @staticmethod
+    def _detect_natnet_version(server_ip=None):
+        """
+        Request the NatNet version from Motive with a ping on the command port.
+        """
+        cmdsock = rx.mkcmdsock()
+        try:
+            sender = rx.ping(cmdsock, server_ip)
+        finally:
+            cmdsock.close()
+        return sender.natnet_version
+
+    def fileno(self):
+        """
+        Return the file descriptor of the data socket, e.g. to wait for
+        frames with a selector.
+        """
+        return self._dsock.fileno()
+
+    def close(self):
+        """
+        Unregister from Motive in unicast mode and close the data socket.
+        """
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+            self._keepalive = None
+        self._dsock.close()
+
+    @property
+    def natnet_version(self):
+        """NatNet version used to decode the received packets."""
+        return self._natnet_version
+
+    @property
+    def tracking_valid(self):
+        """
+        Whether the rigid body last returned by get_rigid_body was tracked,
+        or None if the NatNet version does not report it.
+        """
+        return self._tracking_valid
+
+    @property
+    def models(self):
+        """ModelCache with the model definitions of Motive."""
+        return self._models
+
+    @property
+    def skipped_frames(self):
+        """Total number of packets skipped in latest only mode."""
+        return self._skipped_frames
+
+    @property
+    def last_skipped_frames(self):
+        """Number of packets skipped by the last call in latest only mode."""
+        return self._last_skipped_frames
 
-    def get_packet_data(self, packet_types=[rx.SenderData, rx.ModelDefs, rx.FrameOfData]):
+    def get_packet_data(self, packet_types=[rx.SenderData, rx.ModelDefs, rx.FrameOfData], fields=None):
         """
         Receive desired packet data.
 
@@ -41,18 +157,66 @@ class OptiTrackClient:
         ----------
         packet_types : list, optional
             Types of the packets to be returned.
+            Packets of other types are dropped by their message id
+            before their payload is decoded.
+        fields : list, optional
+            Names of the FrameOfData fields to decode.
+            All other marker and rigid body sections are skipped and set to None.
+            By default, all fields are decoded.
 
         Returns
         -------
         packet : list
             Received packets of desired type.
 
+        """
+        if fields is None:
+            unpack = self._unpack
+        else:
+            unpack = rx.mkunpacker(self._natnet_version, fields)
+        if packet_types:
+            msgtypes = frozenset(rx.MESSAGE_IDS[t] for t in packet_types)
+        else:
+            msgtypes = None
+        return self._recv_packet(unpack, msgtypes)
+
+    def _recv_packet(self, unpack, msgtypes):
+        buf = self._buffers.acquire()
+        spare = self._buffers.acquire() if self._latest_only else None
+        try:
+            # the decoded packet does not refer to the buffers
+            return unpack(self._recv_data(buf, spare, msgtypes))
+        finally:
+            self._buffers.release(buf)
+            if spare is not None:
+                self._buffers.release(spare)
+
+    def _recv_data(self, buf, spare, msgtypes):
+        """
+        Wait for the next packet with one of the message ids and return its data.
+        If a spare buffer is given, all queued packets are read without blocking
+        and the data of the newest packet with one of the message ids is returned.
         """
         while True:
-            data = self._dsock.recv(rx.MAX_PACKETSIZE)
-            packet = rx.unpack(data, version=self._natnet_version)
-            if not packet_types or type(packet) in packet_types:
-                return packet
+            data = rx.recvpacket(self._dsock, buf)
+            if not msgtypes or rx.peek_msgtype(data) in msgtypes:
+                break
+        if spare is None:
+            return data
+
+        skipped = 0
+        while True:
+            newer = rx.recvpacket(self._dsock, spare, nowait=True)
+            if newer is None:
+                break
+            if not msgtypes or rx.peek_msgtype(newer) in msgtypes:
+                # keep the newest data in buf, receive into the other buffer
+                data = newer
+                buf, spare = spare, buf
+                skipped += 1
+        self._last_skipped_frames = skipped
+        self._skipped_frames += skipped
+        return data
 
     def get_rigid_body(self, rb_id=0):
         """
@@ -60,8 +224,8 @@ class OptiTrackClient:
 
         Parameters
         ----------
-        rb_id : int, optional
-            ID of the rigid body to receive data from.
+        rb_id : int or str, optional
+            ID of the rigid body to receive data from, see `rigid_body_index`.
 
         Returns
         -------
@@ -74,14 +238,192 @@ class OptiTrackClient:
             List of time data consisting of frame mumber, timestamp and latency packet data.
 
         """
-        packet = self.get_packet_data()
+        if self._frame is not None:
+            return self._get_rigid_body_into(rb_id)
+
+        # only the rigid bodies and the frame trailer are decoded
+        packet = self._recv_packet(self._unpack_rigid_bodies, _FRAMEOFDATA)
+        index = self.rigid_body_index(packet, rb_id)
+        self._tracking_valid = packet.rigid_bodies[index].tracking_valid
+        return rigid_body_data(packet, index)
+
+    def rigid_body_index(self, frame, rb_id):
+        """
+        Return the position of a rigid body in the rigid body table of a frame.
+
+        Parameters
+        ----------
+        frame : FrameOfData or FrameRecord
+            Decoded frame including its rigid bodies.
+        rb_id : int or str
+            Name of the rigid body, or its rigid body ID of Motive if the
+            client indexes by ID, or else its position in the table.
+        """
+        if isinstance(rb_id, (str, bytes)) or self._index_by_id:
+            return self._models.index(frame, rb_id)
+        return rb_id
+
+    def _get_rigid_body_into(self, rb_id):
+        """
+        Receive rigid body data into the preallocated objects of the reuse mode.
+        """
+        frame = self._frame
+        buf = self._buffers.acquire()
+        spare = self._buffers.acquire() if self._latest_only else None
+        try:
+            self._unpack_into(self._recv_data(buf, spare, _FRAMEOFDATA), frame)
+        finally:
+            self._buffers.release(buf)
+            if spare is not None:
+                self._buffers.release(spare)
+
+        rigid_body = frame.rigid_bodies[self.rigid_body_index(frame, rb_id)]
+        self._tracking_valid = rigid_body.tracking_valid
+        position = self._position
+        position[0], position[1], position[2] = rigid_body.position
+        q = self._orientation.q
+        q[1], q[2], q[3], q[0] = rigid_body.orientation  # (qx, qy, qz, qw)
+        time_data = (frame.frameno, frame.timestamp, frame.latency)
+
+        return position, self._orientation, time_data
+
+class ModelCache(object):
+    """
+    Model definitions of Motive, which map the names and rigid body IDs of
+    Motive to positions in the rigid body table of the frames.
+
+    The definitions are requested over the command socket on the first
+    lookup and again only for frames with the tracked_models_changed flag,
+    such that a lookup costs two dictionary accesses per frame.
+    If Motive does not answer, the IDs are mapped from the table of the
+    frame and names cannot be looked up; the request is not repeated by
+    a lookup before `retry_interval` seconds have passed, such that the
+    frames are not held up by a Motive which does not answer.
+
+    Attributes
+    ----------
+    server_ip : str, optional
+        IP of the Motive software. By default, Motive on the same machine.
+    natnet_version : tuple, optional
+        Version number of the NatNetSDK to decode the definitions with.
+    timeout : float, optional
+        Time in seconds to wait for the definitions.
+    retry_interval : float, optional
+        Time in seconds before a lookup requests the definitions again
+        after Motive did not answer.
+    """
+
+    def __init__(self, server_ip=None, natnet_version=(3, 0, 0, 0), timeout=1.0, retry_interval=10.0):
+        self._server_ip = server_ip
+        self._natnet_version = natnet_version
+        self._timeout = timeout
+        self._retry_interval = retry_interval
+        self._failed_at = None  # time of the last unanswered request
+        self._modeldefs = None
+        self._positions = {}  # rigid body ID -> table position
+        self._ids = {}  # rigid body name -> rigid body ID
+        self._frameno = None  # frame the definitions were refreshed for
+
+    @property
+    def modeldefs(self):
+        """ModelDefs last received from Motive, or None."""
+        return self._modeldefs
+
+    def refresh(self, frame=None):
+        """
+        Request the model definitions from Motive. If there is no answer,
+        map the rigid body IDs from the table of `frame`.
+        """
+        try:
+            cmdsock = rx.mkcmdsock()
+            try:
+                modeldefs = rx.request_modeldef(cmdsock, self._server_ip, timeout=self._timeout,
+                                                version=self._natnet_version)
+            finally:
+                cmdsock.close()
+        except socket.error:
+            modeldefs = None
+        self._modeldefs = modeldefs
+        self._failed_at = time() if modeldefs is None else None
+        self._ids = {}
+        if modeldefs is not None:
+            # the frames list the rigid bodies in the order of their definitions
+            bodies = [dset.data[0] for dset in modeldefs.datasets
+                      if dset.type == rx.DATASET_RIGIDBODY]
+            self._positions = dict((body["id"], i) for i, body in enumerate(bodies))
+            for body in bodies:
+                self._ids[body["name"].decode("utf-8", "replace")] = body["id"]
+        elif frame is not None:
+            self._map_table(frame)
+        if frame is not None:
+            self._frameno = frame.frameno
+
+    def _map_table(self, frame):
+        self._positions = dict((rb.id, i) for i, rb in enumerate(frame.rigid_bodies))
 
-        position = np.array(packet.rigid_bodies[rb_id].position)
-        qx, qy, qz, qw = tuple(packet.rigid_bodies[rb_id].orientation)
-        orientation = Quaternion(a=qw, b=qx, c=qy, d=qz)
-        time_data = (packet.frameno, packet.timestamp, packet.latency)
+    def rigid_body_id(self, name):
+        """Return the rigid body ID of Motive for a rigid body name."""
+        if isinstance(name, bytes):
+            name = name.decode("utf-8", "replace")
+        try:
+            return self._ids[name]
+        except KeyError:
+            raise LookupError("unknown rigid body " + repr(name))
+
+    def index(self, frame, rb_id):
+        """
+        Return the position of a rigid body in the rigid body table of a frame.
+
+        Parameters
+        ----------
+        frame : FrameOfData or FrameRecord
+            Decoded frame including its rigid bodies.
+        rb_id : int or str
+            Rigid body ID of Motive or name of the rigid body.
+        """
+        if self._frameno is None or (frame.tracked_models_changed and
+                                     frame.frameno != self._frameno):
+            if self._failed_at is not None and time() - self._failed_at < self._retry_interval:
+                # Motive did not answer recently, do not wait for it again
+                self._map_table(frame)
+                self._frameno = frame.frameno
+            else:
+                self.refresh(frame)
+        if isinstance(rb_id, (str, bytes)):
+            rb_id = self.rigid_body_id(rb_id)
+        bodies = frame.rigid_bodies
+        position = self._positions.get(rb_id)
+        if position is None or position >= len(bodies) or bodies[position].id != rb_id:
+            # the table does not match the definitions, map it from the frame
+            self._map_table(frame)
+            position = self._positions.get(rb_id)
+            if position is None:
+                raise LookupError("rigid body ID {} is not tracked".format(rb_id))
+        return position
+
+def rigid_body_data(packet, rb_id=0):
+    """
+    Extract rigid body position, orientation and time data from a frame.
+
+    Parameters
+    ----------
+    packet : FrameOfData
+        Decoded frame including its rigid bodies.
+    rb_id : int, optional
+        Position of the rigid body in the rigid body table,
+        see OptiTrackClient.rigid_body_index.
+
+    Returns
+    -------
+    position, orientation, time_data
+        As returned by OptiTrackClient.get_rigid_body.
+    """
+    position = np.array(packet.rigid_bodies[rb_id].position)
+    qx, qy, qz, qw = tuple(packet.rigid_bodies[rb_id].orientation)
+    orientation = Quaternion(a=qw, b=qx, c=qy, d=qz)
+    time_data = (packet.frameno, packet.timestamp, packet.latency)
 
-        return position, orientation, time_data
+    return position, orientation, time_data
 
 class Quaternion(pyquaternion.Quaternion):
     """Work-around until pull request for original packages is accepted
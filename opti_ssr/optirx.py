@@ -5,12 +5,13 @@
 from __future__ import print_function
 
 
+import errno
 import socket
 import struct
 import threading
 from collections import namedtuple
 from platform import python_version_tuple
-from time import sleep
+from time import time
 
 
 if python_version_tuple()[0] < "3":
@@ -26,12 +27,17 @@ __all__ = [
     # packet types:
     'SenderData', 'FrameOfData', 'ModelDefs',
     # payload types:
-    'RigidBody', 'Skeleton', 'LabeledMarker', 'ModelDataset',
+    'RigidBody', 'Skeleton', 'LabeledMarker', 'ForcePlate', 'Device', 'ModelDataset',
+    # reusable records:
+    'FrameRecord', 'RigidBodyRecord',
     # functions:
-    'mkcmdsock', 'mkdatasock', 'unpack',
+    'mkcmdsock', 'mkdatasock', 'recvpacket', 'mkunpacker', 'mkrecordunpacker', 'unpack', 'peek_msgtype', 'ping', 'request_modeldef',
 
     #threads:
-    'DataThread']
+    'DataThread', 'KeepAlive',
+
+    # buffers:
+    'BufferPool']
 
 
 ###
@@ -48,6 +54,8 @@ NAT_MODELDEF =                5
 NAT_REQUEST_FRAMEOFDATA =     6
 NAT_FRAMEOFDATA =             7
 NAT_MESSAGESTRING =           8
+NAT_DISCONNECT =              9                   # since NatNet 3.0
+NAT_KEEPALIVE =               10                  # since NatNet 3.0
 NAT_UNRECOGNIZED_REQUEST =    100
 UNDEFINED =                   999999.9999
 NAT_TYPES = { NAT_PING: "ping",
@@ -59,6 +67,8 @@ NAT_TYPES = { NAT_PING: "ping",
               NAT_REQUEST_FRAMEOFDATA: "request_frameofdata",
               NAT_FRAMEOFDATA: "frameofdata",
               NAT_MESSAGESTRING: "messagestring",
+              NAT_DISCONNECT: "disconnect",
+              NAT_KEEPALIVE: "keepalive",
               NAT_UNRECOGNIZED_REQUEST: "unrecognized" }
 
 
@@ -99,18 +109,30 @@ SenderData = namedtuple("SenderData", "appname version natnet_version")
 #  - id (int, 32 bits)
 #  - x,y,z (3 floats, 3x32 bits)
 #  - qx,qy,qz,qw (4 floats, 4x32 bits)
+#  - markers, marker ids and sizes, version < 3.0
+#  - mean marker error (float), version >= 2.0
+#  - params (short), version >= 2.6
 RIGIDBODY_FORMAT =  "=i3f4f"
 # RigidBody:
 #   id is an integer
 #   position is a triple of coordinates
 #   orientation is a quaternion (qx, qy, qz, qw)
-#   markers is a list of triples
-#   mrk_ids is a list of integers or None (NatNet version < 2.0)
-#   mrk_sizes is a list of floats or None (NatNet version < 2.0)
+#   markers is a list of triples or None (NatNet version >= 3.0)
+#   mrk_ids is a list of integers or None (NatNet version < 2.0 or >= 3.0)
+#   mrk_sizes is a list of floats or None (NatNet version < 2.0 or >= 3.0)
 #   mrk_mean_error is a float or None (NatNet version < 2.0)
 #   tracking_valid is a boolean or None (NatNet version <= 2.6)
 RigidBody = namedtuple("RigidBody",
                        "id position orientation markers mrk_ids mrk_sizes mrk_mean_error tracking_valid")
+# NumPy dtype of the rigid body table in array mode;
+# the markers of the rigid bodies are not included,
+# mrk_mean_error is NaN (NatNet version < 2.0) and
+# tracking_valid is True (NatNet version < 2.6) if not transmitted
+RIGIDBODY_DTYPE = [("id", "=i4"),
+                   ("position", "=f4", (3,)),
+                   ("orientation", "=f4", (4,)),
+                   ("mrk_mean_error", "=f4"),
+                   ("tracking_valid", "?")]
 
 
 # Skeleton (NetNet >= 2.1) is a collection of rigid bodies:
@@ -123,7 +145,24 @@ Skeleton = namedtuple("Skeleton", "id rigid_bodies")
 #   point_cloud_solved, if the position was provided by point cloud solver
 #   model_solved, if the position was provided by model solve
 # if version is older than 2.6 all values named above will be None
-LabeledMarker = namedtuple("LabeledMarker", "id position size occluded point_cloud_solved model_solved")
+# New in NatNet 3.0 is the residual of the marker, None for older versions
+LabeledMarker = namedtuple("LabeledMarker", "id position size occluded point_cloud_solved model_solved residual")
+# NumPy dtype of the labeled markers in array mode, same layout as "i4fhf";
+# params holds the occluded (0x01), point_cloud_solved (0x02) and
+# model_solved (0x04) bits and is missing if version is older than 2.6,
+# residual is missing if version is older than 3.0
+LABELEDMARKER_DTYPE = [("id", "=i4"),
+                       ("position", "=f4", (3,)),
+                       ("size", "=f4"),
+                       ("params", "=i2"),
+                       ("residual", "=f4")]
+
+
+# ForcePlate (NatNet >= 2.9) and Device (NatNet >= 2.11):
+#   id is an integer
+#   channels is a list of tuples of floats, the analog frames of each channel
+ForcePlate = namedtuple("ForcePlate", "id channels")
+Device = namedtuple("Device", "id channels")
 
 
 # frame payload format (PacketClient.cpp:537) cannot be unpacked by
@@ -145,14 +184,64 @@ LabeledMarker = namedtuple("LabeledMarker", "id position size occluded point_clo
 #        + z (float),
 #  - RIGID_BODIES (...)
 #  - SKELETONS (...), ver >= 2.1
+#  - ASSETS (...), ver >= 4.1, always skipped
 #  - LABELED_MARKERS (...), ver >= 2.3
-#  - latency (float),
+#  - FORCE_PLATES (...), ver >= 2.9
+#  - DEVICES (...), ver >= 2.11
+#  - latency (float), version < 3.0,
 #  - timecode (int, int),
 #  - timestamp (double), version >= 2.6(?),
+#  - camera mid exposure, data received and transmit timestamps
+#    (3 unsigned long long), version >= 3.0,
+#  - precision timestamp seconds and fractional seconds
+#    (2 unsigned int), version >= 4.1, not decoded,
 #  - is_recording (boolean), version >= 2.6(?),
 #  - tracked_models_changed (boolean), version >= 2.6(?),
 #  - end of data tag (int).
-FrameOfData = namedtuple("FrameOfData", "frameno sets other_markers rigid_bodies skeletons labeled_markers latency timecode timestamp is_recording tracked_models_changed")
+# Since version 4.1, the element count of every section from MARKERSETS
+# to DEVICES is followed by the size of the section in bytes (int).
+# latency is None for version >= 3.0, use hires_timestamps instead
+# hires_timestamps is a triple of high resolution clock ticks or None
+FrameOfData = namedtuple("FrameOfData", "frameno sets other_markers rigid_bodies skeletons labeled_markers latency timecode timestamp is_recording tracked_models_changed force_plates devices hires_timestamps")
+
+
+class RigidBodyRecord(object):
+    """Reusable rigid body state, overwritten in place by a record decoder.
+
+    position and orientation (qx, qy, qz, qw) are lists which keep their
+    identity, mrk_mean_error and tracking_valid are None if the NatNet
+    version does not send them, like in RigidBody.
+    """
+    __slots__ = ("id", "position", "orientation", "mrk_mean_error", "tracking_valid")
+
+    def __init__(self):
+        self.id = None
+        self.position = [0.0, 0.0, 0.0]
+        self.orientation = [0.0, 0.0, 0.0, 1.0]
+        self.mrk_mean_error = None
+        self.tracking_valid = None
+
+
+class FrameRecord(object):
+    """Reusable frame, overwritten in place by `mkrecordunpacker` decoders.
+
+    Only the rigid bodies and the trailer of the frame are decoded;
+    rigid_bodies is a list of RigidBodyRecord objects, which are reused
+    from frame to frame as long as the number of rigid bodies does not
+    change. The timecode is split into timecode and timecode_sub.
+    """
+    __slots__ = ("frameno", "rigid_bodies", "latency", "timecode", "timecode_sub",
+                 "timestamp", "is_recording", "tracked_models_changed")
+
+    def __init__(self):
+        self.frameno = None
+        self.rigid_bodies = []
+        self.latency = None
+        self.timecode = None
+        self.timecode_sub = None
+        self.timestamp = None
+        self.is_recording = None
+        self.tracked_models_changed = None
 
 
 # type can be one of DATASET_MARKERSET, DATASET_RIGIDBODY, DATASET_SKELETON
@@ -167,266 +256,842 @@ ModelDataset = namedtuple("ModelDataset", "type name data")
 ModelDefs = namedtuple("ModelDefs", "datasets")
 
 
+# message ids of the packet types returned by unpack
+MESSAGE_IDS = { SenderData: NAT_PINGRESPONSE,
+                ModelDefs: NAT_MODELDEF,
+                FrameOfData: NAT_FRAMEOFDATA }
+
+
+_msgtype_struct = struct.Struct("=H")
+
+
+def peek_msgtype(data):
+    """Return the message id of raw NatNet packet data without decoding
+    the payload, or None if the data is too short for a packet header.
+
+    >>> peek_msgtype(b"\\x07\\x00\\x04\\x00abcd")
+    7
+
+    """
+    if len(data) < 4:
+        return None
+    return _msgtype_struct.unpack_from(data)[0]
+
+
 def _version_is_at_least(version, major, minor=None):
     vmajor, vminor = version[:2]
     return (vmajor > major) or ((vmajor == major) and ((not minor) or (vminor >= minor)))
 
 
-def _unpack_head(head_fmt, data):
-    """Unpack some bytes at the head of the data.
-    Return unpacked values and the rest of the data.
+def _unpack_head(head_fmt, data, offset=0):
+    """Unpack some bytes of the data at the given offset.
+    Return unpacked values and the offset of the rest of the data.
 
     >>> _unpack_head('>h', b'\2\1_therest')
-    ((513,), '_therest')
+    ((513,), 2)
 
     """
-    sz = struct.calcsize(head_fmt)
-    vals = struct.unpack(head_fmt, data[:sz])
-    return vals, data[sz:]
+    vals = struct.unpack_from(head_fmt, data, offset)
+    return vals, offset + struct.calcsize(head_fmt)
 
 
-def _unpack_cstring(data, maxstrlen):
-    """"Read a null-terminated string from the head of the data.
-    Return the string and the rest of the data.
+def _unpack_cstring(data, offset, maxstrlen):
+    """"Read a null-terminated string from the data at the given offset.
+    Return the string and the offset of the rest of the data.
 
-    >>> _unpack_cstring("abc%cfoobar" % 0, 6)
-    ('abc', 'foobar')
+    >>> _unpack_cstring(b"abc\\0foobar", 0, 6)
+    (b'abc', 4)
 
     """
-    databuf = data[:maxstrlen]
-    databuflen = min(len(databuf), maxstrlen)
-    (strbuf,) = struct.unpack("%ds" % databuflen, databuf)
+    strbuf = memoryview(data)[offset:offset + maxstrlen].tobytes()
     s = strbuf.split(b"\0", 1)[0]
-    sz = len(s) + 1
-    return s, data[sz:]
+    return s, offset + len(s) + 1
 
 
-def _unpack_sender(payload, size):
-    """Read Sender structure from the head of the data.
-    Return SenderData and the rest of the data."""
-    (appname, v1,v2,v3,v4, nv1,nv2,nv3,nv4), data = _unpack_head(SENDER_FORMAT, payload)
+def _unpack_sender(data, offset, size):
+    """Read Sender structure from the data at the given offset.
+    Return SenderData and the offset of the rest of the data."""
+    (appname, v1,v2,v3,v4, nv1,nv2,nv3,nv4), offset = _unpack_head(SENDER_FORMAT, data, offset)
     appname = appname.split(b"\0",1)[0] if appname else ""
     version = (v1,v2,v3,v4)
     natnet_version = (nv1,nv2,nv3,nv4)
-    return SenderData(appname, version, natnet_version), data
-
-
-def _unpack_markers(data, version):
-    """Read a sequence of markers from the head of the data.
-    Return a list of coordinate triples and the rest of the data."""
-    (nmarkers,), data = _unpack_head("i", data)
-    markers = []
-    for i in xrange(nmarkers):
-        (x, y, z), data = _unpack_head("3f", data)
-        markers.append((x,y,z))
-    return markers, data
-
-
-def _unpack_rigid_bodies(data, version):
-    """Read a sequence of rigid bodies from the head of the data.
-    Return a list of RigidBody tuples and the rest of the data."""
-    (nbodies,), data = _unpack_head("i", data)
-    rbodies = []
-    for i in xrange(nbodies):
-        (rbid, x, y, z, qx, qy, qz, qw), data = _unpack_head(RIGIDBODY_FORMAT, data)
-        markers, data = _unpack_markers(data, version)
+    return SenderData(appname, version, natnet_version), offset
+
+
+_vector_structs = {}
+
+
+def _vector_struct(code, n):
+    """Return a precompiled struct.Struct for `n` items of type `code`."""
+    try:
+        return _vector_structs[code, n]
+    except KeyError:
+        s = _vector_structs[code, n] = struct.Struct("=%d%s" % (n, code))
+        return s
+
+
+def _triples(vals):
+    "Group a flat sequence of coordinates into a list of (x, y, z) tuples."
+    return list(zip(vals[0::3], vals[1::3], vals[2::3]))
+
+
+def _resize_records(records, n, record_type):
+    "Grow or shrink a list of reusable records to length n."
+    if len(records) > n:
+        del records[n:]
+    while len(records) < n:
+        records.append(record_type())
+
+
+def _unpack_nothing(data, offset):
+    "Section reader for sections which are not present in a NatNet version."
+    return [], offset
+
+
+def _skip_nothing(data, offset):
+    "Section skipper for sections which are not present in a NatNet version."
+    return None, offset
+
+
+def _mkframeunpacker(version, fields=None, arrays=False, records=False):
+    """Build a FrameOfData decoder specialized for one NatNet version.
+
+    All version checks are done once here, when the decoder is built:
+    the returned function only runs the section readers and the
+    precompiled structs which apply to `version`.
+    Sections holding none of the `fields` are skipped and are returned
+    as None; since NatNet 4.1 this uses the byte size of the section,
+    for older versions the element counts.
+    In array mode, markers, labeled markers and rigid bodies are
+    returned as NumPy arrays instead of lists of tuples.
+    Return a function `unpack_frameofdata(data, offset)`, or with `records`
+    a function `unpack_frameofdata_into(data, offset, frame)`, which
+    overwrites the rigid bodies and the trailer of a FrameRecord in place.
+    """
+    count_struct = struct.Struct("=i")
+    float_struct = struct.Struct("=f")
+    short_struct = struct.Struct("=h")
+    id_count_struct = struct.Struct("=ii")
+    eod_struct = count_struct
+
+    if _version_is_at_least(version, 4, 1):
+        # element count and section size in bytes
+        def section_count(data, offset):
+            (count,) = count_struct.unpack_from(data, offset)
+            return count, offset + 8
+
+        def skip_section(data, offset):
+            (nbytes,) = count_struct.unpack_from(data, offset + 4)
+            return None, offset + 8 + nbytes
+    else:
+        def section_count(data, offset):
+            (count,) = count_struct.unpack_from(data, offset)
+            return count, offset + 4
+
+        skip_section = None
+
+    def unpack_marker_list(data, offset, nmarkers):
+        vector = _vector_struct("f", 3 * nmarkers)
+        markers = _triples(vector.unpack_from(data, offset))
+        return markers, offset + vector.size
+
+    def unpack_markers(data, offset):
+        (nmarkers,) = count_struct.unpack_from(data, offset)
+        return unpack_marker_list(data, offset + 4, nmarkers)
+
+    def unpack_marker_sets(data, offset):
+        nsets, offset = section_count(data, offset)
+        sets = {}
+        for i in xrange(nsets):
+            setname, offset = _unpack_cstring(data, offset, MAX_NAMELENGTH)
+            sets[setname], offset = unpack_markers(data, offset)
+        return sets, offset
+
+    def skip_marker_sets(data, offset):
+        nsets, offset = section_count(data, offset)
+        for i in xrange(nsets):
+            _, offset = _unpack_cstring(data, offset, MAX_NAMELENGTH)
+            (nmarkers,) = count_struct.unpack_from(data, offset)
+            offset += 4 + 12 * nmarkers
+        return None, offset
+
+    def unpack_other_markers(data, offset):
+        nmarkers, offset = section_count(data, offset)
+        return unpack_marker_list(data, offset, nmarkers)
+
+    def skip_other_markers(data, offset):
+        nmarkers, offset = section_count(data, offset)
+        return None, offset + 12 * nmarkers
+
+    if _version_is_at_least(version, 3, 0):
+        # the markers of the rigid bodies are not sent anymore,
+        # all rigid bodies have the same size
+        rigid_body_struct = struct.Struct(RIGIDBODY_FORMAT + "fh")
+
+        def unpack_rigid_body_list(data, offset, nbodies):
+            rbodies = []
+            for i in xrange(nbodies):
+                (rbid, x, y, z, qx, qy, qz, qw, mrk_mean_error, params) = \
+                    rigid_body_struct.unpack_from(data, offset)
+                offset += rigid_body_struct.size
+                rbodies.append(RigidBody(id=rbid,
+                                         position=(x,y,z),
+                                         orientation=(qx,qy,qz,qw),
+                                         markers=None,
+                                         mrk_ids=None,
+                                         mrk_sizes=None,
+                                         mrk_mean_error=mrk_mean_error,
+                                         tracking_valid=params & 0x01 == 1))
+            return rbodies, offset
+
+        def skip_rigid_body_list(data, offset, nbodies):
+            return None, offset + rigid_body_struct.size * nbodies
+    else:
+        rigid_body_struct = struct.Struct(RIGIDBODY_FORMAT)
+
+        # per rigid body marker information and tracking state
         if _version_is_at_least(version, 2, 0):  # PacketClient.cpp:607
-            nmarkers = len(markers)
-            mrk_ids, data = _unpack_head(str(nmarkers) + "i", data)
-            mrk_sizes, data = _unpack_head(str(nmarkers) + "f", data)
-            (mrk_mean_error,), data = _unpack_head("f", data)
-            tracking_valid = None
             if _version_is_at_least(version, 2, 6): # PacketClient.cpp:622
                 #New in version 2.6 is support for telling if the rigid body
                 #was successfully tracked
-                (params,), data = _unpack_head("h", data)
-                tracking_valid = params & 0x01 == 1
+                def unpack_tracking_valid(data, offset):
+                    (params,) = short_struct.unpack_from(data, offset)
+                    return params & 0x01 == 1, offset + 2
+            else:
+                def unpack_tracking_valid(data, offset):
+                    return None, offset
+
+            def unpack_rigid_body_extra(data, offset, nmarkers):
+                ids_struct = _vector_struct("i", nmarkers)
+                mrk_ids = ids_struct.unpack_from(data, offset)
+                offset += ids_struct.size
+                sizes_struct = _vector_struct("f", nmarkers)
+                mrk_sizes = sizes_struct.unpack_from(data, offset)
+                offset += sizes_struct.size
+                (mrk_mean_error,) = float_struct.unpack_from(data, offset)
+                tracking_valid, offset = unpack_tracking_valid(data, offset + 4)
+                return mrk_ids, mrk_sizes, mrk_mean_error, tracking_valid, offset
         else:
-            mrk_ids, mrk_sizes, mrk_mean_error = None, None, None
-            tracking_valid = None
-        rb = RigidBody(id=rbid,
-                       position=(x,y,z),
-                       orientation=(qx,qy,qz,qw),
-                       markers=markers,
-                       mrk_ids=mrk_ids,
-                       mrk_sizes=mrk_sizes,
-                       mrk_mean_error=mrk_mean_error,
-                       tracking_valid=tracking_valid)
-        rbodies.append(rb)
-    return rbodies, data
-
-
-def _unpack_skeletons(data, version):
-    # not tested
-    if not _version_is_at_least(version, 2, 1):  # PacketClient.cpp:653
-        return [], data
-    (nskels,), data = _unpack_head("i", data)
-    skels = []
-    for i in xrange(nskels):
-        (skelid,), data = _unpack_head("i", data)
-        rbodies, data = _unpack_rigid_bodies(data, version)
-        skels.append(Skeleton(id=skelid, rigid_bodies=rbodies))
-    return skels, data
-
-
-def _unpack_labeled_markers(data, version):
-    if not _version_is_at_least(version, 2, 3): # PacketClient.cpp:734
-        return [], data
-    (nmarkers,), data = _unpack_head("i", data)
-    lmarkers = []
-    if _version_is_at_least(version, 2, 6): # PacketClient.cpp:753
-        #Duplicate looping code to avoid an if check every
-        #loop iteration
-        for _ in xrange(nmarkers):
-            (id, x, y, z, size, params), data = _unpack_head("i4fh", data)
-            #New in version 2.6, PacketClient.cpp 753
-            occluded = params & 0x01 == 1
-            pc_solved = params & 0x02 == 2
-            model_solved = params & 0x04 == 4
-            lmarkers.append(LabeledMarker(id, (x, y, z), size, occluded,
-                pc_solved, model_solved))
+            def unpack_rigid_body_extra(data, offset, nmarkers):
+                return None, None, None, None, offset
+
+        # bytes per rigid body marker (position, id, size) and
+        # bytes after the markers (mean error, params)
+        rb_marker_size = 12
+        rb_tail_size = 0
+        if _version_is_at_least(version, 2, 0):
+            rb_marker_size += 8
+            rb_tail_size += 4
+            if _version_is_at_least(version, 2, 6):
+                rb_tail_size += 2
+
+        def unpack_rigid_body_list(data, offset, nbodies):
+            rbodies = []
+            for i in xrange(nbodies):
+                (rbid, x, y, z, qx, qy, qz, qw) = rigid_body_struct.unpack_from(data, offset)
+                markers, offset = unpack_markers(data, offset + rigid_body_struct.size)
+                mrk_ids, mrk_sizes, mrk_mean_error, tracking_valid, offset = \
+                    unpack_rigid_body_extra(data, offset, len(markers))
+                rbodies.append(RigidBody(id=rbid,
+                                         position=(x,y,z),
+                                         orientation=(qx,qy,qz,qw),
+                                         markers=markers,
+                                         mrk_ids=mrk_ids,
+                                         mrk_sizes=mrk_sizes,
+                                         mrk_mean_error=mrk_mean_error,
+                                         tracking_valid=tracking_valid))
+            return rbodies, offset
+
+        def skip_rigid_body_list(data, offset, nbodies):
+            for i in xrange(nbodies):
+                offset += rigid_body_struct.size
+                (nmarkers,) = count_struct.unpack_from(data, offset)
+                offset += 4 + rb_marker_size * nmarkers + rb_tail_size
+            return None, offset
+
+    def unpack_rigid_bodies(data, offset):
+        nbodies, offset = section_count(data, offset)
+        return unpack_rigid_body_list(data, offset, nbodies)
+
+    def skip_rigid_bodies(data, offset):
+        nbodies, offset = section_count(data, offset)
+        return skip_rigid_body_list(data, offset, nbodies)
+
+    if _version_is_at_least(version, 2, 1):  # PacketClient.cpp:653
+        # not tested
+        def unpack_skeletons(data, offset):
+            nskels, offset = section_count(data, offset)
+            skels = []
+            for i in xrange(nskels):
+                (skelid, nbodies) = id_count_struct.unpack_from(data, offset)
+                rbodies, offset = unpack_rigid_body_list(data, offset + 8, nbodies)
+                skels.append(Skeleton(id=skelid, rigid_bodies=rbodies))
+            return skels, offset
+
+        def skip_skeletons(data, offset):
+            nskels, offset = section_count(data, offset)
+            for i in xrange(nskels):
+                (skelid, nbodies) = id_count_struct.unpack_from(data, offset)
+                _, offset = skip_rigid_body_list(data, offset + 8, nbodies)
+            return None, offset
+    else:
+        unpack_skeletons = _unpack_nothing
+        skip_skeletons = _skip_nothing
+
+    if _version_is_at_least(version, 4, 1):
+        # asset data is not decoded
+        skip_assets = skip_section
+    else:
+        skip_assets = _skip_nothing
+
+    if _version_is_at_least(version, 3, 0):
+        #New in version 3.0 is the residual of the marker
+        labeled_marker_struct = struct.Struct("=i4fhf")
+
+        def make_labeled_marker(id, x, y, z, size, params, residual):
+            return LabeledMarker(id, (x, y, z), size, params & 0x01 == 1,
+                                 params & 0x02 == 2, params & 0x04 == 4,
+                                 residual)
+    elif _version_is_at_least(version, 2, 6): # PacketClient.cpp:753
+        #New in version 2.6, PacketClient.cpp 753
+        labeled_marker_struct = struct.Struct("=i4fh")
+
+        def make_labeled_marker(id, x, y, z, size, params):
+            return LabeledMarker(id, (x, y, z), size, params & 0x01 == 1,
+                                 params & 0x02 == 2, params & 0x04 == 4,
+                                 None)
     else:
-        for _ in xrange(nmarkers):
-            (id, x, y, z, size), data = _unpack_head("i4f", data)
-            lmarkers.append(LabeledMarker(id, (x, y, z), size,
-                None, None, None))
-    return lmarkers, data
-
-
-def _unpack_force_plates(data, version):
-    if not _version_is_at_least(version, 2, 9): # PacketClient-2.9.cpp:859
-        return [], data
-    # not tested, this is just here to parse the packet format
-    (nplates,), data = _unpack_head("i", data)
-    force_plates = []
-
-    if nplates > 0:
-        raise NotImplementedError("Force plate data not supported.")
-
-    return force_plates, data
-
-def _unpack_frameofdata(data, version):
-    (frameno, nsets), data = _unpack_head("ii", data)
-    # identified marker sets
-    sets = {}
-    for i in xrange(nsets):
-        setname, data = _unpack_cstring(data, MAX_NAMELENGTH)
-        markers, data = _unpack_markers(data, version)
-        sets[setname] = markers
-    # other (unidentified) markers
-    markers, data = _unpack_markers(data, version)
-    bodies, data = _unpack_rigid_bodies(data, version)
-    skels, data = _unpack_skeletons(data, version)
-    lmarkers, data = _unpack_labeled_markers(data, version)
-    forceplates, data = _unpack_force_plates(data, version)
-    if _version_is_at_least(version, 2, 7):
-        # In version 2.7, the timestamp was changed from float to double
-        (latency, timecode, timecode_sub, timestamp, params), data = _unpack_head("=fIIdh", data)
-        # '!' because of padding
-        is_recording = params & 0x01 == 1
-        tracked_models_changed = params & 0x02 == 2
-    elif _version_is_at_least(version, 2, 6): # PacketClient.cpp:779
-        # In the latest version of PacketClient.cpp several new parameters
-        # have been added at the end with no version checking, since version
-        # 2.5 did not have these parameters the code here have been added in
-        # an if statement
-        (latency, timecode, timecode_sub, timestamp, params), data = _unpack_head(
-                "fIIfh", data)
-        is_recording = params & 0x01 == 1
-        tracked_models_changed = params & 0x02 == 2
+        labeled_marker_struct = struct.Struct("=i4f")
+
+        def make_labeled_marker(id, x, y, z, size):
+            return LabeledMarker(id, (x, y, z), size, None, None, None, None)
+
+    if _version_is_at_least(version, 2, 3): # PacketClient.cpp:734
+        def unpack_labeled_markers(data, offset):
+            nmarkers, offset = section_count(data, offset)
+            lmarkers = []
+            for _ in xrange(nmarkers):
+                lmarkers.append(make_labeled_marker(
+                    *labeled_marker_struct.unpack_from(data, offset)))
+                offset += labeled_marker_struct.size
+            return lmarkers, offset
+
+        def skip_labeled_markers(data, offset):
+            nmarkers, offset = section_count(data, offset)
+            return None, offset + labeled_marker_struct.size * nmarkers
     else:
-        (latency, timecode, timecode_sub), data = _unpack_head(
-                "fII", data)
-        is_recording = None
-        tracked_models_changed = None
-        timestamp = None
-    (eod,), data = _unpack_head("i", data)
-    assert eod == 0, "End-of-data marker is not 0."
-    fod = FrameOfData(frameno=frameno,
-                      sets=sets,
-                      other_markers=markers,
-                      rigid_bodies=bodies,
-                      skeletons=skels,
-                      labeled_markers=lmarkers,
-                      latency=latency,
-                      timecode=(timecode, timecode_sub),
-                      timestamp=timestamp,
-                      is_recording=is_recording,
-                      tracked_models_changed=tracked_models_changed)
-    return fod, data
-
-
-def _unpack_modeldef(data, version):
-    """Return ModelDefs and the rest of the data.
+        unpack_labeled_markers = _unpack_nothing
+        skip_labeled_markers = _skip_nothing
+
+    # force plates and devices share the same layout:
+    #  - id, number of channels (2 ints)
+    #  - CHANNELS, each of them:
+    #     * number of frames (int)
+    #     * frames (floats)
+    def mkanalogreaders(analog_type):
+        def unpack_analog(data, offset):
+            nitems, offset = section_count(data, offset)
+            items = []
+            for i in xrange(nitems):
+                (item_id, nchannels) = id_count_struct.unpack_from(data, offset)
+                offset += 8
+                channels = []
+                for j in xrange(nchannels):
+                    (nframes,) = count_struct.unpack_from(data, offset)
+                    vector = _vector_struct("f", nframes)
+                    channels.append(vector.unpack_from(data, offset + 4))
+                    offset += 4 + vector.size
+                items.append(analog_type(item_id, channels))
+            return items, offset
+
+        def skip_analog(data, offset):
+            nitems, offset = section_count(data, offset)
+            for i in xrange(nitems):
+                (item_id, nchannels) = id_count_struct.unpack_from(data, offset)
+                offset += 8
+                for j in xrange(nchannels):
+                    (nframes,) = count_struct.unpack_from(data, offset)
+                    offset += 4 + 4 * nframes
+            return None, offset
+
+        return unpack_analog, skip_analog
+
+    if _version_is_at_least(version, 2, 9): # PacketClient-2.9.cpp:859
+        unpack_force_plates, skip_force_plates = mkanalogreaders(ForcePlate)
+    else:
+        unpack_force_plates = _unpack_nothing
+        skip_force_plates = _skip_nothing
+
+    if _version_is_at_least(version, 2, 11):
+        unpack_devices, skip_devices = mkanalogreaders(Device)
+    else:
+        unpack_devices = _unpack_nothing
+        skip_devices = _skip_nothing
+
+    if _version_is_at_least(version, 3, 0):
+        # In version 3.0, latency was replaced by high resolution timestamps
+        if _version_is_at_least(version, 4, 1):
+            # In version 4.1, the precision timestamp (seconds and fractional
+            # seconds) was added before params, it is not decoded
+            trailer_struct = struct.Struct("=IIdQQQIIh")
+        else:
+            trailer_struct = struct.Struct("=IIdQQQh")
+
+        def unpack_trailer(data, offset):
+            values = trailer_struct.unpack_from(data, offset)
+            (timecode, timecode_sub, timestamp, mid_exposure, received, transmit) = values[:6]
+            params = values[-1]
+            return (None, (timecode, timecode_sub), timestamp,
+                    params & 0x01 == 1, params & 0x02 == 2,
+                    (mid_exposure, received, transmit)), \
+                offset + trailer_struct.size
+    elif _version_is_at_least(version, 2, 6):
+        if _version_is_at_least(version, 2, 7):
+            # In version 2.7, the timestamp was changed from float to double
+            trailer_struct = struct.Struct("=fIIdh")
+        else: # PacketClient.cpp:779
+            # In the latest version of PacketClient.cpp several new parameters
+            # have been added at the end with no version checking, since version
+            # 2.5 did not have these parameters
+            trailer_struct = struct.Struct("=fIIfh")
+
+        def unpack_trailer(data, offset):
+            (latency, timecode, timecode_sub, timestamp, params) = \
+                trailer_struct.unpack_from(data, offset)
+            return (latency, (timecode, timecode_sub), timestamp,
+                    params & 0x01 == 1, params & 0x02 == 2, None), \
+                offset + trailer_struct.size
+    else:
+        trailer_struct = struct.Struct("=fII")
+
+        def unpack_trailer(data, offset):
+            (latency, timecode, timecode_sub) = trailer_struct.unpack_from(data, offset)
+            return (latency, (timecode, timecode_sub), None, None, None, None), \
+                offset + trailer_struct.size
+
+    if arrays:
+        import numpy as np
+        marker_dtype = np.dtype("=f4")
+        rigid_body_dtype = np.dtype(RIGIDBODY_DTYPE)
+        if _version_is_at_least(version, 3, 0):
+            labeled_marker_dtype = np.dtype(LABELEDMARKER_DTYPE)
+        elif _version_is_at_least(version, 2, 6):
+            labeled_marker_dtype = np.dtype(LABELEDMARKER_DTYPE[:-1])
+        else:
+            labeled_marker_dtype = np.dtype(LABELEDMARKER_DTYPE[:-2])
+        assert labeled_marker_dtype.itemsize == labeled_marker_struct.size
+
+        def array_marker_list(data, offset, nmarkers):
+            # N x 3 view on the packet data
+            markers = np.frombuffer(data, marker_dtype, 3 * nmarkers, offset)
+            return markers.reshape(nmarkers, 3), offset + 12 * nmarkers
+
+        def array_marker_sets(data, offset):
+            nsets, offset = section_count(data, offset)
+            sets = {}
+            for i in xrange(nsets):
+                setname, offset = _unpack_cstring(data, offset, MAX_NAMELENGTH)
+                (nmarkers,) = count_struct.unpack_from(data, offset)
+                sets[setname], offset = array_marker_list(data, offset + 4, nmarkers)
+            return sets, offset
+
+        def array_other_markers(data, offset):
+            nmarkers, offset = section_count(data, offset)
+            return array_marker_list(data, offset, nmarkers)
+
+        if _version_is_at_least(version, 3, 0):
+            # the rigid bodies have a fixed size and are read in one go
+            rigid_body_wire_dtype = np.dtype(RIGIDBODY_DTYPE[:-1] + [("params", "=i2")])
+            assert rigid_body_wire_dtype.itemsize == rigid_body_struct.size
+
+            def array_rigid_body_list(data, offset, nbodies):
+                wire = np.frombuffer(data, rigid_body_wire_dtype, nbodies, offset)
+                rbodies = np.empty(nbodies, rigid_body_dtype)
+                for name in ("id", "position", "orientation", "mrk_mean_error"):
+                    rbodies[name] = wire[name]
+                rbodies["tracking_valid"] = wire["params"] & 0x01 == 1
+                return rbodies, offset + rigid_body_wire_dtype.itemsize * nbodies
+        else:
+            if _version_is_at_least(version, 2, 6):
+                rigid_body_state_struct = struct.Struct("=fh")
+
+                def unpack_rigid_body_state(data, offset):
+                    (mrk_mean_error, params) = rigid_body_state_struct.unpack_from(data, offset)
+                    return mrk_mean_error, params & 0x01 == 1, offset + 6
+            elif _version_is_at_least(version, 2, 0):
+                def unpack_rigid_body_state(data, offset):
+                    (mrk_mean_error,) = float_struct.unpack_from(data, offset)
+                    return mrk_mean_error, True, offset + 4
+            else:
+                def unpack_rigid_body_state(data, offset):
+                    return float("nan"), True, offset
+
+            def array_rigid_body_list(data, offset, nbodies):
+                rows = []
+                for i in xrange(nbodies):
+                    (rbid, x, y, z, qx, qy, qz, qw) = rigid_body_struct.unpack_from(data, offset)
+                    offset += rigid_body_struct.size
+                    (nmarkers,) = count_struct.unpack_from(data, offset)
+                    offset += 4 + (rb_marker_size * nmarkers)
+                    mrk_mean_error, tracking_valid, offset = unpack_rigid_body_state(data, offset)
+                    rows.append((rbid, (x, y, z), (qx, qy, qz, qw), mrk_mean_error, tracking_valid))
+                return np.array(rows, dtype=rigid_body_dtype), offset
+
+        def array_rigid_bodies(data, offset):
+            nbodies, offset = section_count(data, offset)
+            return array_rigid_body_list(data, offset, nbodies)
+
+        if _version_is_at_least(version, 2, 1):
+            def array_skeletons(data, offset):
+                nskels, offset = section_count(data, offset)
+                skels = []
+                for i in xrange(nskels):
+                    (skelid, nbodies) = id_count_struct.unpack_from(data, offset)
+                    rbodies, offset = array_rigid_body_list(data, offset + 8, nbodies)
+                    skels.append(Skeleton(id=skelid, rigid_bodies=rbodies))
+                return skels, offset
+        else:
+            array_skeletons = _unpack_nothing
+
+        if _version_is_at_least(version, 2, 3):
+            def array_labeled_markers(data, offset):
+                # structured view on the packet data
+                nmarkers, offset = section_count(data, offset)
+                lmarkers = np.frombuffer(data, labeled_marker_dtype, nmarkers, offset)
+                return lmarkers, offset + labeled_marker_dtype.itemsize * nmarkers
+        else:
+            array_labeled_markers = _unpack_nothing
+
+        readers = (array_marker_sets, array_other_markers, array_rigid_bodies,
+                   array_skeletons, array_labeled_markers,
+                   unpack_force_plates, unpack_devices)
+    else:
+        readers = (unpack_marker_sets, unpack_other_markers, unpack_rigid_bodies,
+                   unpack_skeletons, unpack_labeled_markers,
+                   unpack_force_plates, unpack_devices)
+    skippers = (skip_marker_sets, skip_other_markers, skip_rigid_bodies,
+                skip_skeletons, skip_labeled_markers,
+                skip_force_plates, skip_devices)
+    if skip_section is not None:
+        # jump over sections using their size, if they are present
+        skippers = [skip_section if skipper is not _skip_nothing else skipper
+                    for skipper in skippers]
+
+    if records:
+        # decode only the rigid bodies and the trailer into a FrameRecord
+        (skip_marker_sets, skip_other_markers, _, skip_skeletons,
+         skip_labeled_markers, skip_force_plates, skip_devices) = skippers
+
+        if _version_is_at_least(version, 3, 0):
+            def rigid_bodies_into(data, offset, nbodies, rbodies):
+                _resize_records(rbodies, nbodies, RigidBodyRecord)
+                for rb in rbodies:
+                    pos = rb.position
+                    ori = rb.orientation
+                    (rb.id, pos[0], pos[1], pos[2], ori[0], ori[1], ori[2], ori[3],
+                     rb.mrk_mean_error, params) = rigid_body_struct.unpack_from(data, offset)
+                    rb.tracking_valid = params & 0x01 == 1
+                    offset += rigid_body_struct.size
+                return offset
+        else:
+            if _version_is_at_least(version, 2, 6):
+                rigid_body_state_struct = struct.Struct("=fh")
+
+                def rigid_body_state_into(data, offset, rb):
+                    (rb.mrk_mean_error, params) = rigid_body_state_struct.unpack_from(data, offset)
+                    rb.tracking_valid = params & 0x01 == 1
+                    return offset + 6
+            elif _version_is_at_least(version, 2, 0):
+                def rigid_body_state_into(data, offset, rb):
+                    (rb.mrk_mean_error,) = float_struct.unpack_from(data, offset)
+                    return offset + 4
+            else:
+                def rigid_body_state_into(data, offset, rb):
+                    return offset
+
+            def rigid_bodies_into(data, offset, nbodies, rbodies):
+                _resize_records(rbodies, nbodies, RigidBodyRecord)
+                for rb in rbodies:
+                    pos = rb.position
+                    ori = rb.orientation
+                    (rb.id, pos[0], pos[1], pos[2], ori[0], ori[1], ori[2], ori[3]) = \
+                        rigid_body_struct.unpack_from(data, offset)
+                    offset += rigid_body_struct.size
+                    (nmarkers,) = count_struct.unpack_from(data, offset)
+                    offset = rigid_body_state_into(
+                        data, offset + 4 + rb_marker_size * nmarkers, rb)
+                return offset
+
+        if _version_is_at_least(version, 3, 0):
+            def trailer_into(data, offset, frame):
+                values = trailer_struct.unpack_from(data, offset)
+                (frame.timecode, frame.timecode_sub, frame.timestamp) = values[:3]
+                params = values[-1]
+                frame.is_recording = params & 0x01 == 1
+                frame.tracked_models_changed = params & 0x02 == 2
+                return offset + trailer_struct.size
+        elif _version_is_at_least(version, 2, 6):
+            def trailer_into(data, offset, frame):
+                (frame.latency, frame.timecode, frame.timecode_sub, frame.timestamp, params) = \
+                    trailer_struct.unpack_from(data, offset)
+                frame.is_recording = params & 0x01 == 1
+                frame.tracked_models_changed = params & 0x02 == 2
+                return offset + trailer_struct.size
+        else:
+            def trailer_into(data, offset, frame):
+                (frame.latency, frame.timecode, frame.timecode_sub) = \
+                    trailer_struct.unpack_from(data, offset)
+                return offset + trailer_struct.size
+
+        def unpack_frameofdata_into(data, offset, frame):
+            (frame.frameno,) = count_struct.unpack_from(data, offset)
+            _, offset = skip_marker_sets(data, offset + 4)
+            _, offset = skip_other_markers(data, offset)
+            nbodies, offset = section_count(data, offset)
+            offset = rigid_bodies_into(data, offset, nbodies, frame.rigid_bodies)
+            _, offset = skip_skeletons(data, offset)
+            _, offset = skip_assets(data, offset)
+            _, offset = skip_labeled_markers(data, offset)
+            _, offset = skip_force_plates(data, offset)
+            _, offset = skip_devices(data, offset)
+            offset = trailer_into(data, offset, frame)
+            (eod,) = eod_struct.unpack_from(data, offset)
+            assert eod == 0, "End-of-data marker is not 0."
+            return offset + eod_struct.size
+
+        return unpack_frameofdata_into
+
+    # section readers for the wanted fields, skippers for all others
+    wanted = FrameOfData._fields if fields is None else fields
+    (read_marker_sets, read_other_markers, read_rigid_bodies,
+     read_skeletons, read_labeled_markers,
+     read_force_plates, read_devices) = [
+        reader if name in wanted else skipper
+        for name, reader, skipper in zip(
+            ("sets", "other_markers", "rigid_bodies", "skeletons",
+             "labeled_markers", "force_plates", "devices"),
+            readers, skippers)]
+
+    def unpack_frameofdata(data, offset):
+        (frameno,) = count_struct.unpack_from(data, offset)
+        # identified marker sets
+        sets, offset = read_marker_sets(data, offset + 4)
+        # other (unidentified) markers
+        markers, offset = read_other_markers(data, offset)
+        bodies, offset = read_rigid_bodies(data, offset)
+        skels, offset = read_skeletons(data, offset)
+        _, offset = skip_assets(data, offset)
+        lmarkers, offset = read_labeled_markers(data, offset)
+        forceplates, offset = read_force_plates(data, offset)
+        devices, offset = read_devices(data, offset)
+        (latency, timecode, timestamp, is_recording, tracked_models_changed, hires_timestamps), offset = \
+            unpack_trailer(data, offset)
+        (eod,) = eod_struct.unpack_from(data, offset)
+        assert eod == 0, "End-of-data marker is not 0."
+        fod = FrameOfData(frameno=frameno,
+                          sets=sets,
+                          other_markers=markers,
+                          rigid_bodies=bodies,
+                          skeletons=skels,
+                          labeled_markers=lmarkers,
+                          latency=latency,
+                          timecode=timecode,
+                          timestamp=timestamp,
+                          is_recording=is_recording,
+                          tracked_models_changed=tracked_models_changed,
+                          force_plates=forceplates,
+                          devices=devices,
+                          hires_timestamps=hires_timestamps)
+        return fod, offset + eod_struct.size
+
+    return unpack_frameofdata
+
+
+def _unpack_rigid_body_description(data, offset, version):
+    """Return the description of a rigid body as a dictionary
+    and the offset of the rest of the data.
+    """
+    if _version_is_at_least(version, 2, 0):
+        name, offset = _unpack_cstring(data, offset, MAX_NAMELENGTH)
+    else:
+        name = ""
+    (rbid, parent, xoff, yoff, zoff), offset = _unpack_head("2i3f", data, offset)
+    body = {"name": name,
+            "id": rbid,
+            "parent": parent,
+            "offset": (xoff, yoff, zoff)}
+    if _version_is_at_least(version, 3, 0):
+        # PacketClient.cpp: per-marker data since NatNet 3.0
+        (nmarkers,), offset = _unpack_head("i", data, offset)
+        positions, offset = _unpack_head("%df" % (3 * nmarkers), data, offset)
+        labels, offset = _unpack_head("%di" % nmarkers, data, offset)
+        body["marker_offsets"] = _triples(positions)
+        body["marker_labels"] = list(labels)
+        if _version_is_at_least(version, 4, 0):
+            names = []
+            for j in xrange(nmarkers):
+                mrk_name, offset = _unpack_cstring(data, offset, MAX_NAMELENGTH)
+                names.append(mrk_name)
+            body["marker_names"] = names
+    return body, offset
+
+
+def _unpack_modeldef(data, offset, version):
+    """Return ModelDefs and the offset of the rest of the data.
+
+    Marker sets, rigid bodies and skeletons are decoded. Datasets of other
+    types (force plates, devices, cameras) are skipped by their size since
+    NatNet 4.1; in older versions decoding stops at the first of them.
     """
     # PacketClient.cpp:765
-    (ndatasets,), data = _unpack_head("i", data)
+    (ndatasets,), offset = _unpack_head("i", data, offset)
+    sized = _version_is_at_least(version, 4, 1)
     datasets = []
     for i in xrange(ndatasets):
-        (dtype,), data = _unpack_head("i", data)
+        (dtype,), offset = _unpack_head("i", data, offset)
+        if sized:
+            (nbytes,), offset = _unpack_head("i", data, offset)
+            end = offset + nbytes
         if dtype == DATASET_MARKERSET:
-            name, data = _unpack_cstring(data, MAX_NAMELENGTH)
-            (nmarkers,), data = _unpack_head("i", data)
+            name, offset = _unpack_cstring(data, offset, MAX_NAMELENGTH)
+            (nmarkers,), offset = _unpack_head("i", data, offset)
             mrk_names = []
-            for j in xrange(nMarkers):
-                mrk_name, data = _unpack_cstring(data, MAX_NAMELENGTH)
+            for j in xrange(nmarkers):
+                mrk_name, offset = _unpack_cstring(data, offset, MAX_NAMELENGTH)
                 mrk_names.append(mrk_name)
             dset = ModelDataset(DATASET_MARKERSET, name, mrk_names)
             datasets.append(dset)
         elif dtype == DATASET_RIGIDBODY:
-            if _version_is_at_least(version, 2, 0):
-                name, data = _unpack_cstring(data, MAX_NAMELENGTH)
-            else:
-                name = ""
-            (rbid, parent, xoff, yoff, zoff), data = _unpack_head("2i3f", data)
-            dset = ModelDataset(DATASET_RIGIDBODY, name,
-                            [{"id": rbid,
-                              "parent": parent,
-                              "offset": (xoff, yoff, zoff)}])
+            body, offset = _unpack_rigid_body_description(data, offset, version)
+            dset = ModelDataset(DATASET_RIGIDBODY, body["name"], [body])
             datasets.append(dset)
         elif dtype == DATASET_SKELETON:
-            name, data = _unpack_cstring(data, MAX_NAMELENGTH)
-            (skid, nbodies), data = _unpack_head("2i", data)
+            name, offset = _unpack_cstring(data, offset, MAX_NAMELENGTH)
+            (skid, nbodies), offset = _unpack_head("2i", data, offset)
             bodies = []
             for j in xrange(nbodies):
-                if _version_is_at_least(version, 2, 0):
-                    bname, data = _unpack_cstring(data, MAX_NAMELENGTH)
-                else:
-                    bname = ""
-                (rbid, parent, xoff, yoff, zoff), data = _unpack_head("2i3f", data)
-                body = {"id": rbid,
-                        "parent": parent,
-                        "offset": (xoff, yoff, zoff)}
+                body, offset = _unpack_rigid_body_description(data, offset, version)
                 bodies.append(body)
-            dset = ModelDataset(DATASET_RIGIDBODY, name, bodies)
+            dset = ModelDataset(DATASET_SKELETON, name, bodies)
             datasets.append(dset)
+        elif not sized:
+            # the size of unknown datasets is not known before NatNet 4.1
+            break
+        if sized:
+            offset = end
+    return ModelDefs(datasets), offset
+
+
+_unpackers = {}
+
+
+def mkunpacker(version=(2, 5, 0, 0), fields=None, arrays=False):
+    """Return a packet decoder specialized for one NatNet version.
+
+    The decoder is built once per version and set of fields and cached.
+    It uses precompiled structs and does no version checks while decoding.
+
+    Arguments:
+      version  version of the NatNet protocol (a tuple of integers)
+      fields   names of the FrameOfData fields to decode, or None for all;
+               the sections of other fields are skipped, by their size
+               in bytes if the version has one, and set to None
+      arrays   if True, return markers as N x 3 float32 arrays and
+               labeled markers (LABELEDMARKER_DTYPE) as NumPy views on
+               `data`, and rigid bodies as a RIGIDBODY_DTYPE array
+
+    Return a function `unpack_packet(data)`, which behaves like `unpack`.
+    """
+    version = tuple(version)
+    if fields is not None:
+        fields = frozenset(fields)
+        unknown = fields.difference(FrameOfData._fields)
+        if unknown:
+            raise ValueError("unknown FrameOfData fields: " + ", ".join(sorted(unknown)))
+    key = (version, fields, bool(arrays))
+    try:
+        return _unpackers[key]
+    except KeyError:
+        pass
+    header_struct = struct.Struct(PACKET_HEADER_FORMAT)
+    unpack_frameofdata = _mkframeunpacker(version, fields, arrays)
+
+    def unpack_packet(data):
+        if not data or len(data) < 4:
+            return None
+        data = memoryview(data)
+        (msgtype, nbytes) = header_struct.unpack_from(data, 0)
+        offset = header_struct.size
+        if msgtype == NAT_FRAMEOFDATA:
+            frame, offset = unpack_frameofdata(data, offset)
+            return frame
+        elif msgtype == NAT_PINGRESPONSE:
+            sender, offset = _unpack_sender(data, offset, nbytes)
+            return sender
+        elif msgtype == NAT_MODELDEF:
+            modeldef, offset = _unpack_modeldef(data, offset, version)
+            return modeldef
         else:
-            raise NotImplementedError("dataset type " + str(dtype))
-    return ModelDefs(datasets), data
+            # TODO: implement other message types
+            raise NotImplementedError("packet type " + str(NAT_TYPES.get(msgtype, msgtype)))
 
+    _unpackers[key] = unpack_packet
+    return unpack_packet
 
-def unpack(data, version=(2, 5, 0, 0)):
-    """Unpack raw NatNet packet data.
+
+_record_unpackers = {}
+
+
+def mkrecordunpacker(version=(2, 5, 0, 0)):
+    """Return a decoder which overwrites a FrameRecord in place.
+
+    Only the rigid bodies and the trailer of NAT_FRAMEOFDATA packets are
+    decoded; the records of the frame are reused from packet to packet,
+    so decoding a stream with a constant number of rigid bodies creates
+    no frame or rigid body objects.
 
     Arguments:
-      data     byte buffer
       version  version of the NatNet protocol (a tuple of integers)
+
+    Return a function `unpack_into(data, frame)`, which returns `frame`
+    for frames and None for all other packets.
     """
-    if not data or len(data) < 4:
-        return None
-    (msgtype, nbytes), data = _unpack_head(PACKET_HEADER_FORMAT, data)
-    if msgtype == NAT_PINGRESPONSE:
-        sender, data = _unpack_sender(data, nbytes)
-        return sender
-    elif msgtype == NAT_FRAMEOFDATA:
-        frame, data = _unpack_frameofdata(data, version)
+    version = tuple(version)
+    try:
+        return _record_unpackers[version]
+    except KeyError:
+        pass
+    header_struct = struct.Struct(PACKET_HEADER_FORMAT)
+    unpack_frameofdata_into = _mkframeunpacker(version, records=True)
+
+    def unpack_into(data, frame):
+        if not data or len(data) < 4:
+            return None
+        (msgtype, nbytes) = header_struct.unpack_from(data, 0)
+        if msgtype != NAT_FRAMEOFDATA:
+            return None
+        unpack_frameofdata_into(data, header_struct.size, frame)
         return frame
-    elif msgtype == NAT_MODELDEF:
-        modeldef, data = _unpack_modeldef(data, version)
-        return modeldef
-    else:
-        # TODO: implement other message types
-        raise NotImplementedError("packet type " + str(NAT_TYPES.get(msgtype, msgtype)))
+
+    _record_unpackers[version] = unpack_into
+    return unpack_into
+
+
+def unpack(data, version=(2, 5, 0, 0), fields=None, arrays=False):
+    """Unpack raw NatNet packet data.
+
+    The packet is decoded in place: all fields are read from a single
+    memoryview of `data` with a running offset, so no part of the packet
+    is copied while decoding. Use `mkunpacker` to get the decoder for
+    a fixed version once instead of looking it up for every packet.
+
+    Arguments:
+      data     byte buffer (bytes, bytearray or memoryview)
+      version  version of the NatNet protocol (a tuple of integers)
+      fields   names of the FrameOfData fields to decode, or None for all
+      arrays   decode markers and rigid bodies into NumPy arrays
+    """
+    return mkunpacker(version, fields, arrays)(data)
 
 
 ###
@@ -452,73 +1117,300 @@ def mkcmdsock(ip_address=None, port=0):
     return cmdsock
 
 
-def mkdatasock(ip_address=None, multicast_address=MULTICAST_ADDRESS, port=PORT_DATA):
-    "Create a data socket."
+def mkdatasock(ip_address=None, multicast_address=MULTICAST_ADDRESS, port=PORT_DATA,
+               command_port=PORT_COMMAND):
+    """Create a data socket.
+
+    Without `ip_address`, the socket joins the multicast group. Otherwise
+    it registers for unicast data with the NatNet server at `ip_address`
+    by a connect request to its command port, and the server sends the
+    frames to this socket only. The server drops the registration unless
+    it is kept alive, see `KeepAlive`.
+    """
     datasock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
     datasock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     datasock.bind(('', port))
-    # join a multicast group
-    mreq = struct.pack("=4sl", socket.inet_aton(multicast_address), socket.INADDR_ANY)
-    datasock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    if ip_address:
+        # the connect request of unicast clients is a ping (PacketClient.cpp)
+        datasock.sendto(mkpacket(NAT_PING, b"Ping\0"), (ip_address, command_port))
+    else:
+        # join a multicast group
+        mreq = struct.pack("=4sl", socket.inet_aton(multicast_address), socket.INADDR_ANY)
+        datasock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
     datasock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFSIZE)
     return datasock
 
 
+def mkpacket(msgtype, payload=b""):
+    "Pack a NatNet packet with the given message id and payload."
+    return struct.pack(PACKET_HEADER_FORMAT, msgtype, len(payload)) + payload
+
+
+def _request(cmdsock, msgtype, payload, reply, server_address, port, timeout, version):
+    """Send a command and return the decoded reply with message id `reply`.
+    Raise socket.timeout if there is no reply within `timeout` seconds.
+    """
+    server_address = gethostip() if not server_address else server_address
+    cmdsock.sendto(mkpacket(msgtype, payload), (server_address, port))
+    deadline = time() + timeout
+    while True:
+        remaining = deadline - time()
+        if remaining <= 0:
+            raise socket.timeout("no %s from %s" % (NAT_TYPES[reply], server_address))
+        cmdsock.settimeout(remaining)
+        data = cmdsock.recv(MAX_PACKETSIZE)
+        if peek_msgtype(data) == reply:
+            return unpack(data, version)
+
+
+def ping(cmdsock, server_address=None, port=PORT_COMMAND, timeout=1.0):
+    """Ping a NatNet server over the command socket.
+
+    Return the SenderData of the server, which includes its NatNet version.
+    Raise socket.timeout if there is no answer within `timeout` seconds.
+    """
+    return _request(cmdsock, NAT_PING, b"Ping\0", NAT_PINGRESPONSE,
+                    server_address, port, timeout, (2, 5, 0, 0))
+
+
+def request_modeldef(cmdsock, server_address=None, port=PORT_COMMAND, timeout=1.0,
+                     version=(2, 5, 0, 0)):
+    """Request the model definitions from a NatNet server over the command socket.
+
+    Return ModelDefs decoded for the given NatNet version.
+    Raise socket.timeout if there is no answer within `timeout` seconds.
+    """
+    return _request(cmdsock, NAT_REQUEST_MODELDEF, b"", NAT_MODELDEF,
+                    server_address, port, timeout, version)
+
+
+class BufferPool(object):
+    """A small pool of preallocated receive buffers.
+
+    The buffers are memoryviews of bytearrays of `size` bytes, to be
+    filled by `recvpacket`. A buffer has to be released once the packet
+    in it is consumed; decoded tuples and records do not refer to the
+    buffer, but the NumPy views of the array mode do.
+    If all buffers are in use, `acquire` allocates a new one.
+    """
+
+    def __init__(self, count=4, size=MAX_PACKETSIZE):
+        self._size = size
+        self._count = count
+        self._free = [memoryview(bytearray(size)) for _ in xrange(count)]
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        "Take a buffer from the pool."
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return memoryview(bytearray(self._size))
+
+    def release(self, buf):
+        "Return a buffer to the pool."
+        with self._lock:
+            if len(self._free) < self._count:
+                self._free.append(buf)
+
+
+# errors of non-blocking reads from an empty socket
+_WOULDBLOCK = frozenset([errno.EAGAIN, errno.EWOULDBLOCK,
+                         getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)])
+
+
+if hasattr(socket, "MSG_DONTWAIT"):
+    def _recv_into_nowait(sock, buf):
+        return sock.recv_into(buf, 0, socket.MSG_DONTWAIT)
+else:
+    def _recv_into_nowait(sock, buf):
+        timeout = sock.gettimeout()
+        sock.setblocking(0)
+        try:
+            return sock.recv_into(buf)
+        finally:
+            sock.settimeout(timeout)
+
+
+def recvpacket(sock, buf, nowait=False):
+    """Receive one datagram into the buffer `buf` (see BufferPool).
+    Return a memoryview of the received bytes.
+
+    If `nowait` is True, do not block and return None if no datagram
+    is queued on the socket.
+    """
+    if not nowait:
+        nbytes = sock.recv_into(buf)
+    else:
+        try:
+            nbytes = _recv_into_nowait(sock, buf)
+        except socket.error as e:
+            if e.errno in _WOULDBLOCK:
+                return None
+            raise
+    return buf[:nbytes]
+
+
+class KeepAlive(threading.Thread):
+    """Thread keeping the unicast registration of a data socket alive.
+
+    Every `interval` seconds a keep alive message is sent to the command
+    port of the server, or the connect request again before NatNet 3.0,
+    which has no keep alive message. `cancel` stops the thread and
+    unregisters the socket since NatNet 3.0.
+    """
+
+    def __init__(self, sock, server_address, port=PORT_COMMAND,
+                 version=(2, 5, 0, 0), interval=1.0):
+        super(KeepAlive, self).__init__()
+        self.daemon = True
+        self._quit = threading.Event()
+        self._sock = sock
+        self._address = (server_address, port)
+        self._interval = interval
+        self._has_keepalive = _version_is_at_least(version, 3, 0)
+        if self._has_keepalive:
+            self._packet = mkpacket(NAT_KEEPALIVE)
+        else:
+            self._packet = mkpacket(NAT_PING, b"Ping\0")
+
+    def run(self):
+        while not self._quit.wait(self._interval):
+            try:
+                self._sock.sendto(self._packet, self._address)
+            except socket.error:
+                # the next message may get through, e.g. after a link is up again
+                pass
+
+    def cancel(self):
+        self._quit.set()
+        if self._has_keepalive:
+            try:
+                self._sock.sendto(mkpacket(NAT_DISCONNECT), self._address)
+            except socket.error:
+                pass
+
+
+# message ids decoded by `unpack`
+_UNPACKED_MSGTYPES = frozenset(MESSAGE_IDS.values())
+# message ids queued in unicast mode, where the replies to the connect
+# and keep alive pings arrive on the data socket as well
+_STREAMED_MSGTYPES = frozenset([NAT_FRAMEOFDATA, NAT_MODELDEF])
+
+
 class DataThread(threading.Thread):
     def __init__(self, ip_address=None, multicast_address=MULTICAST_ADDRESS,
                  port=PORT_DATA, version=(2, 5, 0, 0), packet_limit=500,
-                 *args, **kwargs):
+                 timeout=0.1, *args, **kwargs):
         """Thread used to continually pull data from the data socket.
 
+        The packets are kept in a ring buffer of `packet_limit` packets,
+        the oldest packets are overwritten when it is full. Consumers are
+        woken by a condition variable as soon as a packet arrives.
+
         Keyword arguments:
-        ip_address -- the IP address passed to `mkdatasock`
+        ip_address -- the IP address passed to `mkdatasock`; if given,
+                      the unicast registration is kept alive while running
         multicast_address -- the multicast address passed to `mkdatasock`
         port -- the data port passed to `mkdatasock`
         version -- the NatNetSDK version tuple passed to `unpack`
         packet_limit -- the number of packets to keep in the internal queue
+        timeout -- the socket timeout, after which `cancel` is checked
         """
         super(DataThread, self).__init__(*args, **kwargs)
 
-        self._stop = threading.Event()
+        self._quit = threading.Event()
 
         self._socket = mkdatasock(ip_address=ip_address,
                                   multicast_address=multicast_address,
                                   port=port)
-        self._socket.setblocking(0)
-
-        self._packet_buf = []
-        self._packet_lock = threading.Lock()
-        self._packet_available = threading.Event()
+        self._socket.settimeout(timeout)
+        if ip_address:
+            self._keepalive = KeepAlive(self._socket, ip_address, version=version)
+            self._msgtypes = _STREAMED_MSGTYPES
+        else:
+            self._keepalive = None
+            self._msgtypes = _UNPACKED_MSGTYPES
+
+        # ring buffer: _packet_head is the next slot to write,
+        # _packet_count the number of unread packets before it
+        self._packet_buf = [None] * packet_limit
+        self._packet_head = 0
+        self._packet_count = 0
+        self._packet_cond = threading.Condition()
         self._packet_limit = packet_limit
 
         self._version = version
+        self._unpack = mkunpacker(version)
+        self._buffers = BufferPool(count=1)
 
     def cancel(self):
-        self._stop.set()
+        self._quit.set()
+        with self._packet_cond:
+            self._packet_cond.notify_all()
+
+    def _pop_packets(self, num):
+        "Remove and return the `num` oldest packets, the lock has to be held."
+        buf = self._packet_buf
+        start = (self._packet_head - self._packet_count) % self._packet_limit
+        ret = []
+        for i in xrange(num):
+            idx = (start + i) % self._packet_limit
+            ret.append(buf[idx])
+            buf[idx] = None
+        self._packet_count -= num
+        return ret
 
     def get_packets(self):
         """Returns a list of all packets seen so far."""
-        if self._packet_available.wait(timeout=0.1):
-            with self._packet_lock:
-                ret = self._packet_buf[:]
-                self._packet_buf = []
-                self._packet_available.clear()
-        else:
-            ret = []
-        return ret
+        with self._packet_cond:
+            if not self._packet_count:
+                self._packet_cond.wait(0.1)
+            return self._pop_packets(self._packet_count)
+
+    def wait_next(self, timeout=None):
+        """Return the oldest unread packet, waiting up to `timeout` seconds
+        (forever if None) for one to arrive. Return None on timeout or
+        if the thread was cancelled."""
+        with self._packet_cond:
+            if not self._packet_count and not self._quit.is_set():
+                self._packet_cond.wait(timeout)
+            if not self._packet_count:
+                return None
+            return self._pop_packets(1)[0]
+
+    def iter_packets(self):
+        """Iterate over the received packets, blocking until each arrives,
+        until the thread is cancelled."""
+        while True:
+            packet = self.wait_next()
+            if packet is None:
+                if self._quit.is_set():
+                    return
+                continue
+            yield packet
 
     def run(self):
-        while not self._stop.is_set():
+        if self._keepalive is not None:
+            self._keepalive.start()
+        buf = self._buffers.acquire()
+        while not self._quit.is_set():
             try:
-                data = self._socket.recv(MAX_PACKETSIZE)
-            except socket.error:
-                # Thrown when recv finds no data (non-blocking mode)
-                sleep(0.1)
-            else:
-                packet = unpack(data, version=self._version)
-                with self._packet_lock:
-                    self._packet_buf.append(packet)
-                    self._packet_buf = self._packet_buf[-self._packet_limit:]
-                self._packet_available.set()
+                data = recvpacket(self._socket, buf)
+            except socket.timeout:
+                continue
+            if peek_msgtype(data) not in self._msgtypes:
+                # e.g. replies to the keep alive messages
+                continue
+            # decoded packets do not refer to the buffer
+            packet = self._unpack(data)
+            with self._packet_cond:
+                self._packet_buf[self._packet_head] = packet
+                self._packet_head = (self._packet_head + 1) % self._packet_limit
+                if self._packet_count < self._packet_limit:
+                    self._packet_count += 1
+                self._packet_cond.notify_all()
+        self._buffers.release(buf)
+        if self._keepalive is not None:
+            self._keepalive.cancel()
         self._socket.close()
-
@@ -0,0 +1,205 @@
+"""
+A python module to compose tracking applications from generator stages.
+
+Every stage takes an iterable and lazily yields its results one by one,
+so a chain of stages runs in the thread of its consumer without any
+buffering or copying between the stages, and each stage can be fed from
+a list to be tested or benchmarked on its own.
+
+The stages pass either frames (FrameOfData) or poses, which are tuples
+``(position, orientation, time_data)`` as returned by
+OptiTrackClient.get_rigid_body. A head tracker for the SSR reads as::
+
+    calibration = Calibration()
+    poses = select_rigid_body(client_source(optitrack), rb_id=0)
+    poses = transform(poses, calibration)
+    azimuths = head_orientation(throttle(poses, max_rate=60))
+    sink(azimuths, ssr.set_ref_orientation)
+"""
+
+from __future__ import print_function
+import struct
+from time import time, sleep
+import numpy as np
+
+from . import optirx as rx
+from .opti_client import Quaternion, rigid_body_data
+
+
+### sources ###
+
+def client_source(optitrack):
+    """
+    Yield the frames received by an OptiTrackClient.
+    Only the rigid bodies and the trailer of the frames are decoded.
+    """
+    while True:
+        yield optitrack.get_packet_data([rx.FrameOfData], fields=("rigid_bodies",))
+
+
+def socket_source(sock, natnet_version=(3, 0, 0, 0), fields=None):
+    """
+    Yield the frames received on a NatNet data socket (see optirx.mkdatasock).
+    """
+    unpack = rx.mkunpacker(natnet_version, fields)
+    buffers = rx.BufferPool(count=1)
+    buf = buffers.acquire()
+    try:
+        while True:
+            data = rx.recvpacket(sock, buf)
+            if rx.peek_msgtype(data) == rx.NAT_FRAMEOFDATA:
+                # the decoded frame does not refer to the buffer
+                yield unpack(data)
+    finally:
+        buffers.release(buf)
+
+
+def record_packets(sock, fileobj, num):
+    """
+    Write `num` raw packets received on a NatNet data socket to a binary file,
+    to be read by `replay_source`.
+    """
+    for _ in range(num):
+        fileobj.write(sock.recv(rx.MAX_PACKETSIZE))
+
+
+def replay_source(fileobj, natnet_version=(3, 0, 0, 0), fields=None, rate=None):
+    """
+    Yield the frames of a binary file of raw NatNet packets, as written by
+    `record_packets`. If `rate` is given, frames are yielded with at most
+    `rate` frames per second, otherwise as fast as they are consumed.
+    """
+    unpack = rx.mkunpacker(natnet_version, fields)
+    header = struct.Struct(rx.PACKET_HEADER_FORMAT)
+    data = memoryview(fileobj.read())
+    offset = 0
+    period = 1.0 / rate if rate else 0.0
+    next_time = time()
+    while offset + header.size <= len(data):
+        msgtype, nbytes = header.unpack_from(data, offset)
+        packet = data[offset:offset + header.size + nbytes]
+        offset += header.size + nbytes
+        if msgtype != rx.NAT_FRAMEOFDATA:
+            continue
+        if period:
+            delay = next_time - time()
+            if delay > 0:
+                sleep(delay)
+            next_time += period
+        yield unpack(packet)
+
+
+### stages ###
+
+def select_rigid_body(frames, rb_id=0):
+    """
+    Yield the pose of one rigid body of every frame.
+    """
+    for frame in frames:
+        yield rigid_body_data(frame, rb_id)
+
+
+class Calibration(object):
+    """
+    Origin and orientation of the world coordinate system used by `transform`.
+    Calibrating with the current pose of a rigid body makes it the new origin,
+    which takes effect for the next pose passing the transform stage.
+    """
+
+    def __init__(self, origin=(0, 0, 0), orientation=None):
+        self.origin = np.array(origin)
+        self.orientation = Quaternion(1, 0, 0, 0) if orientation is None else orientation
+
+    def calibrate(self, position, orientation):
+        """
+        Use a position and orientation to set the origin and orientation
+        of the world coordinate system.
+        """
+        # copies, the client may overwrite its arrays in place
+        self.origin = np.array(position)
+        self.orientation = Quaternion(orientation)
+
+    def apply(self, position, orientation):
+        """
+        Return position and orientation in the world coordinate system.
+        """
+        # not commutative
+        return position - self.origin, self.orientation.conjugate * orientation
+
+
+def transform(poses, calibration):
+    """
+    Yield the poses in the world coordinate system of a Calibration.
+    """
+    for position, orientation, time_data in poses:
+        position, orientation = calibration.apply(position, orientation)
+        yield position, orientation, time_data
+
+
+def lowpass(poses, alpha=0.5):
+    """
+    Yield the poses with exponentially smoothed positions,
+    the weight of the newest position is `alpha`.
+    """
+    smoothed = None
+    for position, orientation, time_data in poses:
+        if smoothed is None:
+            smoothed = np.array(position, dtype=float)
+        else:
+            smoothed = alpha * position + (1 - alpha) * smoothed
+        yield smoothed, orientation, time_data
+
+
+def throttle(items, max_rate, clock=time):
+    """
+    Yield at most `max_rate` items per second, dropping the items in between.
+    """
+    period = 1.0 / max_rate
+    last = None
+    for item in items:
+        now = clock()
+        if last is None or now - last >= period:
+            last = now
+            yield item
+
+
+def head_azimuth(ypr, angle=1):
+    """
+    Return the azimuth in degrees for the SSR reference orientation
+    from yaw, pitch and roll in radians; see HeadTracker for `angle`.
+    """
+    return np.sign(angle) * ypr[np.absolute(angle) - 1] * 180 / np.pi + 90
+
+
+def head_orientation(poses, angle=1):
+    """
+    Yield the azimuth of the poses for the SSR reference orientation.
+    """
+    for _, orientation, _ in poses:
+        yield head_azimuth(orientation.yaw_pitch_roll, angle)
+
+
+def reference_position(poses):
+    """
+    Yield the x, y coordinates of the poses for the SSR reference position.
+    """
+    for position, _, _ in poses:
+        yield position[0], position[1]
+
+
+### sinks ###
+
+def sink(items, func):
+    """
+    Call `func` for every item, a tuple item is passed as separate arguments,
+    e.g. `sink(reference_position(poses), ssr.set_ref_position)`.
+    Return the number of consumed items once the items are exhausted.
+    """
+    count = 0
+    for item in items:
+        if isinstance(item, tuple):
+            func(*item)
+        else:
+            func(item)
+        count += 1
+    return count
@@ -0,0 +1,274 @@
+"""
+A python module to share the rigid bodies received from the OptiTrack
+system between processes on one host.
+
+A FramePublisher receives and decodes every frame once and writes the
+rigid bodies of the latest frames into a ring buffer in shared memory.
+Any number of FrameReader objects in other processes read the current
+pose from there, without a socket and without decoding packets.
+
+Writes are guarded by a sequence lock: the publisher makes the sequence
+number odd while it writes and even again when it is done, readers
+retry if the number was odd or changed while they copied a frame.
+
+This module requires Python 3.8 or newer.
+"""
+
+from __future__ import print_function
+from multiprocessing import shared_memory, resource_tracker, parent_process
+from time import sleep, monotonic
+import numpy as np
+
+from . import optirx as rx
+from .opti_client import Quaternion
+
+# sequence: sequence lock, odd while a frame is written
+# count: number of frames written so far
+# max_bodies, history: size of the frame ring buffer
+_HEADER_DTYPE = np.dtype([("sequence", "=u8"),
+                          ("count", "=u8"),
+                          ("max_bodies", "=u4"),
+                          ("history", "=u4")])
+
+# names of the shared memory blocks created by publishers in this process
+_created = set()
+
+# seconds between the retries of a reader waiting for the publisher
+_RETRY_INTERVAL = 0.0005
+
+
+def _frame_dtype(max_bodies):
+    # latency is NaN if the NatNet version does not send it
+    return np.dtype([("frameno", "=i4"),
+                     ("nbodies", "=i4"),
+                     ("timestamp", "=f8"),
+                     ("latency", "=f8"),
+                     ("rigid_bodies", rx.RIGIDBODY_DTYPE, (max_bodies,))])
+
+
+class _SharedFrames(object):
+    """Header and frame ring buffer views on a shared memory block."""
+
+    def _map(self, shm, max_bodies, history):
+        self._shm = shm
+        self._header = np.ndarray((), _HEADER_DTYPE, shm.buf, 0)
+        self._frames = np.ndarray((history,), _frame_dtype(max_bodies), shm.buf,
+                                  _HEADER_DTYPE.itemsize)
+        self._history = history
+
+    @property
+    def name(self):
+        """Name of the shared memory block."""
+        return self._shm.name
+
+    def close(self):
+        """Release the views and detach from the shared memory block."""
+        # the views have to be gone before the block can be closed
+        self._header = self._frames = None
+        self._shm.close()
+
+
+class FramePublisher(_SharedFrames):
+    """
+    Receive frames from the OptiTrack system and publish their rigid bodies
+    in shared memory.
+
+    Attributes
+    ----------
+    name : str, optional
+        Name of the shared memory block. By default, a unique name is chosen.
+    max_bodies : int, optional
+        Maximum number of rigid bodies stored per frame.
+    history : int, optional
+        Number of frames kept in shared memory.
+    unicast_ip : str, optional
+        IP of the Motive software to establish a unicast connection to.
+        By default, no unicast connection is established.
+    multicast_ip : str, optional
+        Multicast address to connect to.
+    port : int, optional
+        Port of the Motive network interface.
+    natnet_version : tuple, optional
+        Version number of the NatNetSDK to use.
+    """
+
+    def __init__(self, name=None, max_bodies=32, history=64, unicast_ip=None,
+                 multicast_ip="239.255.42.99", port=1511, natnet_version=(3, 0, 0, 0)):
+        size = _HEADER_DTYPE.itemsize + history * _frame_dtype(max_bodies).itemsize
+        self._map(shared_memory.SharedMemory(name=name, create=True, size=size),
+                  max_bodies, history)
+        _created.add(self._shm.name)
+        self._header["sequence"] = 0
+        self._header["count"] = 0
+        self._header["max_bodies"] = max_bodies
+        self._header["history"] = history
+        self._max_bodies = max_bodies
+
+        self._unicast_ip = unicast_ip
+        self._multicast_ip = multicast_ip
+        self._port = port
+        self._natnet_version = natnet_version
+        self._unpack = rx.mkunpacker(natnet_version, fields=("rigid_bodies",), arrays=True)
+
+    def unlink(self):
+        """Destroy the shared memory block, after all readers are closed."""
+        self._shm.unlink()
+        _created.discard(self._shm.name)
+
+    def publish(self, frame):
+        """
+        Write the rigid bodies of a frame decoded in array mode
+        (see optirx.mkunpacker) to the shared memory.
+        """
+        header = self._header
+        count = int(header["count"])
+        sequence = int(header["sequence"])
+        slot = self._frames[count % self._history]
+        nbodies = min(len(frame.rigid_bodies), self._max_bodies)
+
+        header["sequence"] = sequence + 1
+        slot["frameno"] = frame.frameno
+        slot["nbodies"] = nbodies
+        slot["timestamp"] = np.nan if frame.timestamp is None else frame.timestamp
+        slot["latency"] = np.nan if frame.latency is None else frame.latency
+        slot["rigid_bodies"][:nbodies] = frame.rigid_bodies[:nbodies]
+        header["count"] = count + 1
+        header["sequence"] = sequence + 2
+
+    def run(self, dsock=None):
+        """
+        Receive and publish frames until the process is terminated.
+        By default, a new data socket is created.
+        """
+        keepalive = None
+        if dsock is None:
+            dsock = rx.mkdatasock(ip_address=self._unicast_ip,
+                                  multicast_address=self._multicast_ip,
+                                  port=self._port)
+            if self._unicast_ip:
+                keepalive = rx.KeepAlive(dsock, self._unicast_ip, version=self._natnet_version)
+                keepalive.start()
+        buf = rx.BufferPool(count=1).acquire()
+        try:
+            while True:
+                data = rx.recvpacket(dsock, buf)
+                if rx.peek_msgtype(data) == rx.NAT_FRAMEOFDATA:
+                    # the rigid body table is a copy, not a view on buf
+                    self.publish(self._unpack(data))
+        finally:
+            if keepalive is not None:
+                keepalive.cancel()
+
+
+class FrameReader(_SharedFrames):
+    """
+    Read the rigid bodies published by a FramePublisher in another process.
+
+    get_rigid_body waits for a frame newer than the one it returned last,
+    like OptiTrackClient.get_rigid_body waits for the next packet, such
+    that a FrameReader can replace the OptiTrackClient of a bridge.
+
+    Attributes
+    ----------
+    name : str
+        Name of the shared memory block of the publisher.
+    """
+
+    def __init__(self, name):
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python < 3.13 registers the block to be destroyed on exit by the
+            # resource tracker, which is shared with the publisher in its own
+            # process and in processes started by multiprocessing, but is our
+            # own in unrelated processes
+            shm = shared_memory.SharedMemory(name=name)
+            if parent_process() is None and shm.name not in _created:
+                resource_tracker.unregister(shm._name, "shared_memory")
+        header = np.ndarray((), _HEADER_DTYPE, shm.buf, 0)
+        max_bodies, history = int(header["max_bodies"]), int(header["history"])
+        del header
+        self._map(shm, max_bodies, history)
+        self._returned = 0  # count of the frame returned last by get_rigid_body
+
+    @property
+    def count(self):
+        """Number of frames published so far."""
+        return int(self._header["count"])
+
+    def _read(self, num, timeout):
+        """Return the frame count and a consistent copy of the last `num` frames."""
+        header = self._header
+        deadline = None
+        while True:
+            sequence = int(header["sequence"])
+            if not sequence & 1:
+                count = int(header["count"])
+                num = min(num, count, self._history)
+                idx = np.arange(count - num, count) % self._history
+                frames = self._frames[idx]  # fancy indexing copies
+                if int(header["sequence"]) == sequence:
+                    return count, frames
+            # a frame is written, or was written while it was copied,
+            # the publisher may have died in the middle of a write
+            if deadline is None:
+                deadline = monotonic() + timeout
+            elif monotonic() > deadline:
+                raise TimeoutError("the publisher did not finish writing a frame")
+            else:
+                sleep(_RETRY_INTERVAL)
+
+    def get_history(self, num=1, timeout=1.0):
+        """
+        Return a consistent copy of the last `num` published frames,
+        oldest first, as a structured array. It is empty if nothing
+        was published yet. TimeoutError is raised if a frame is written
+        for more than `timeout` seconds.
+        """
+        return self._read(num, timeout)[1]
+
+    def get_frame(self, timeout=1.0):
+        """
+        Return a consistent copy of the latest frame, or None.
+        """
+        frames = self.get_history(1, timeout)
+        return frames[0] if len(frames) else None
+
+    def wait_frame(self, timeout=1.0):
+        """
+        Wait up to `timeout` seconds for a frame newer than the one
+        get_rigid_body returned last. Return whether there is one.
+        """
+        deadline = monotonic() + timeout
+        while int(self._header["count"]) <= self._returned:
+            if monotonic() > deadline:
+                return False
+            sleep(_RETRY_INTERVAL)
+        return True
+
+    def get_rigid_body(self, rb_id=0, wait=True, timeout=1.0):
+        """
+        Return rigid body position, orientation and time data of the latest
+        frame as OptiTrackClient.get_rigid_body does.
+
+        If `wait` is True, it waits up to `timeout` seconds for a frame newer
+        than the one returned last and raises TimeoutError, a socket.error
+        like the timeout of an OptiTrackClient, if none is published.
+        Otherwise, it returns the latest frame at once.
+        """
+        if wait and not self.wait_frame(timeout):
+            raise TimeoutError("no new frame within {0} s".format(timeout))
+        count, frames = self._read(1, timeout)
+        if not len(frames):
+            raise LookupError("no frame published yet")
+        frame = frames[0]
+        self._returned = count
+        if not 0 <= rb_id < frame["nbodies"]:
+            # the slots beyond nbodies hold stale or empty rigid bodies
+            raise IndexError("rigid body {0} not in frame {1}".format(rb_id, int(frame["frameno"])))
+        rigid_body = frame["rigid_bodies"][rb_id]
+        position = np.array(rigid_body["position"], dtype=float)
+        qx, qy, qz, qw = rigid_body["orientation"]
+        orientation = Quaternion(a=qw, b=qx, c=qy, d=qz)
+        time_data = (int(frame["frameno"]), float(frame["timestamp"]), float(frame["latency"]))
+        return position, orientation, time_data
@@ -3,101 +3,565 @@ A python module for controlling the SoundScape Renderer.
 """
 from __future__ import print_function
 import socket
+import threading
+from collections import OrderedDict
+import xml.etree.ElementTree as ET
+import numpy as np
 
-class SSRClient:
+# XML elements of the requests to the SSR, {f} stands for a float
+_ELEMENTS = {
+    'src_creation': '<source new="true" id="%d" port="0"></source>',
+    'ref_position': '<reference><position x="{f}" y="{f}"/></reference>',
+    'ref_offset_position': '<reference_offset><position x="{f}" y="{f}"/></reference_offset>',
+    'ref_orientation': '<reference><orientation azimuth="{f}"/></reference>',
+    'ref_offset_orientation': '<reference_offset><orientation azimuth="{f}"/></reference_offset>',
+    'src_position': '<source id="%d" name="SourceMotive%d"><position x="{f}" y="{f}"/></source>',
+    'src_orientation': '<source id="%d"><orientation azimuth="{f}"/></source>',
+    'src_xy': '<source id="%d"><position x="{f}" y="{f}"/></source>',
+    'src_pose': '<source id="%d"><position x="{f}" y="{f}"/><orientation azimuth="{f}"/></source>',
+    'scene': '<scene load="%s"/>',
+    'transport_state': '<state transport="%s"/>',
+}
+
+class MessageEncoder(object):
     """
-    Establish a TCP/IP4 network connection and send XML messages
-    to communicate with a specific instance of the SoundScape Renderer.
+    Encode requests to the SSR with byte templates, which are compiled once
+    for a fixed number of decimals of the floats.
 
     Attributes
     ----------
-    ip : str, optional
-        IP of the server running thr SSR. By default, it connects to localhost.
-    port : int, optional
-        Port of SSR Network Interface. By default, port = 4711.
+    precision : int, optional
+        Number of decimals of the floats.
     end_message : str, optional
-        Symbol to terminate the XML messages send to SSR. By default, a binary zero.
+        Symbol to terminate the XML messages. By default, a binary zero.
     """
 
-    def __init__(self, ip='localhost', port=4711, end_message='\0'):
-        self._ip = ip
-        self._port = port
-        self._end_message = end_message
+    def __init__(self, precision=4, end_message='\0'):
+        self.precision = precision
+        float_format = '%.{0}f'.format(precision)
+        self._head = b'<request>'
+        self._tail = ('</request>' + end_message).encode()
+        # name -> template of the element, template of the complete message
+        self._elements = {}
+        self._messages = {}
+        for name, element in _ELEMENTS.items():
+            element = element.replace('{f}', float_format).encode()
+            self._elements[name] = element
+            self._messages[name] = self._head + element + self._tail
 
-        # IP4 and TCP connection
-        self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._s.connect((self._ip, self._port))
+    def element(self, name, *args):
+        """
+        Return the XML element of a request, e.g. element('ref_position', x, y).
+        """
+        return self._elements[name] % args
 
-    def __del__(self):
-        self._s.close()
-        print("SSRClient: socket closed")
+    def message(self, name, *args):
+        """
+        Return the complete message of a request with a single element.
+        """
+        return self._messages[name] % args
+
+    def encode_many(self, requests, merge=False):
+        """
+        Encode a sequence of (name, args) requests and return the messages
+        as one bytes object, to be written with a single call. If `merge`
+        is True, the requests are encoded as one message.
+        """
+        if merge:
+            templates = self._elements
+            chunks = [self._head]
+        else:
+            templates = self._messages
+            chunks = []
+        chunks.extend([templates[name] % args for name, args in requests])
+        if merge:
+            chunks.append(self._tail)
+        # in CPython, one join is faster than copying the chunks one by
+        # one into a preallocated bytearray
+        return b''.join(chunks)
+
+# requests of which only the latest value matters, keyed by name
+# or by name and source id
+_LATEST_BY_NAME = frozenset(['ref_position', 'ref_offset_position',
+                             'ref_orientation', 'ref_offset_orientation'])
+_LATEST_BY_SOURCE = frozenset(['src_position', 'src_orientation', 'src_xy', 'src_pose'])
+
+class LatestValueWriter(threading.Thread):
+    """
+    A thread which writes the requests to the SSR, such that callers never
+    block on the socket.
+
+    Only the latest value of a position or orientation waits to be written,
+    a newer value overwrites a queued older one. Other requests, like the
+    creation of a source, are written in order before the queued values.
+
+    Attributes
+    ----------
+    sock : socket
+        Connected socket of the SSR.
+    encoder : MessageEncoder
+        Encoder of the requests.
+    merge : bool, optional
+        If True, all requests written at once are merged into a single request.
+    """
+
+    def __init__(self, sock, encoder, merge=False):
+        super(LatestValueWriter, self).__init__()
+        self.daemon = True
+        self._sock = sock
+        self._encoder = encoder
+        self._merge = merge
+        self._cond = threading.Condition()
+        self._quit = False
+        self._ready = False  # something to write
+        self._commands = []  # (name, args), written in order
+        self._latest = OrderedDict()  # key -> (name, args)
+        self.error = None  # exception which ended the thread
+        self.overwritten = 0  # values replaced before they were written
+
+    def put(self, name, args, wake=True):
+        """
+        Queue a request, replacing a queued value of the same key.
+        If `wake` is False, it is written at the next `wake`.
+        """
+        if self.error is not None:
+            raise self.error
+        if name in _LATEST_BY_NAME:
+            key = name
+        elif name in _LATEST_BY_SOURCE:
+            key = (name, args[0])
+        else:
+            key = None
+        with self._cond:
+            if key is None:
+                self._commands.append((name, args))
+            else:
+                if key in self._latest:
+                    self.overwritten += 1
+                self._latest[key] = (name, args)
+            if wake:
+                self._ready = True
+                self._cond.notify()
+
+    def wake(self):
+        """Write all queued requests."""
+        with self._cond:
+            self._ready = True
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._quit = True
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not (self._ready or self._quit):
+                    self._cond.wait()
+                if self._quit:
+                    return
+                requests = self._commands + list(self._latest.values())
+                self._commands = []
+                self._latest = OrderedDict()
+                self._ready = False
+            if not requests:
+                continue
+            try:
+                # values arriving meanwhile are queued and overwrite each other
+                self._sock.sendall(self._encoder.encode_many(requests, self._merge))
+            except socket.error as e:
+                self.error = e
+                return
+
+class SceneState(object):
+    """
+    Mirror of the scene of the SSR, kept up to date from the updates
+    the SSR sends, see ResponseReader.
+
+    Positions are (x, y) tuples in meters, orientations azimuths in degrees,
+    both None until the SSR reported them. `sources` maps source ids to
+    dictionaries with the attributes of the sources and their 'position'
+    and 'orientation'. `transport` is e.g. 'start' or 'stop'.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reference_position = None
+        self.reference_orientation = None
+        self.reference_offset_position = None
+        self.reference_offset_orientation = None
+        self.sources = {}
+        self.transport = None
+
+    def source(self, src_id):
+        """Return a copy of the state of a source, or None."""
+        with self._lock:
+            state = self.sources.get(int(src_id))
+            return None if state is None else dict(state)
+
+    def update(self, element):
+        """Apply an XML update of the SSR."""
+        with self._lock:
+            for child in element:
+                if child.tag == 'reference':
+                    self.reference_position, self.reference_orientation = \
+                        _pose(child, self.reference_position, self.reference_orientation)
+                elif child.tag == 'reference_offset':
+                    self.reference_offset_position, self.reference_offset_orientation = \
+                        _pose(child, self.reference_offset_position, self.reference_offset_orientation)
+                elif child.tag == 'source' and 'id' in child.attrib:
+                    state = self.sources.setdefault(int(child.attrib['id']), {})
+                    state.update(child.attrib)
+                    state['position'], state['orientation'] = \
+                        _pose(child, state.get('position'), state.get('orientation'))
+                elif child.tag == 'delete':
+                    for source in child.iter('source'):
+                        self.sources.pop(int(source.attrib.get('id', -1)), None)
+                elif child.tag == 'state' and 'transport' in child.attrib:
+                    self.transport = child.attrib['transport']
+
+def _pose(element, position, orientation):
+    """Return position and orientation of an XML element, or the given ones."""
+    node = element.find('position')
+    if node is not None:
+        position = (float(node.get('x', 0)), float(node.get('y', 0)))
+    node = element.find('orientation')
+    if node is not None:
+        orientation = float(node.get('azimuth', 0))
+    return position, orientation
+
+class ResponseParser(object):
+    """
+    Split the stream of messages returned by the SSR incrementally
+    and apply the updates to a SceneState.
+
+    Attributes
+    ----------
+    end_message : str, optional
+        Symbol terminating the XML messages of the SSR. By default, a binary zero.
+    """
+
+    def __init__(self, end_message='\0'):
+        self._buf = bytearray()
+        self._end = end_message.encode()
+        self.scene = SceneState()
+        self.messages = 0  # number of received messages
+        self.errors = 0  # number of messages which could not be parsed
+
+    def feed(self, data):
+        """Parse the complete messages of the received data."""
+        buf, end, end_size = self._buf, self._end, len(self._end)
+        # messages may be split over and packed into segments
+        start = len(buf)
+        buf += data
+        pos = buf.find(end, max(0, start - end_size + 1))
+        while pos >= 0:
+            self._handle(bytes(buf[:pos]))
+            del buf[:pos + end_size]
+            pos = buf.find(end)
+
+    def _handle(self, msg):
+        self.messages += 1
+        try:
+            element = ET.fromstring(msg)
+        except ET.ParseError:
+            self.errors += 1
+            return
+        if element.tag == 'update':
+            self.scene.update(element)
+
+class ResponseReader(threading.Thread):
+    """
+    A thread which reads the messages the SSR returns, such that no other
+    thread blocks on them, and keeps a SceneState of the SSR.
+
+    Attributes
+    ----------
+    sock : socket
+        Connected socket of the SSR.
+    end_message : str, optional
+        Symbol terminating the XML messages of the SSR. By default, a binary zero.
+    """
+
+    def __init__(self, sock, end_message='\0'):
+        super(ResponseReader, self).__init__()
+        self.daemon = True
+        self._sock = sock
+        self.parser = ResponseParser(end_message)
+
+    @property
+    def scene(self):
+        """SceneState mirroring the SSR."""
+        return self.parser.scene
+
+    def run(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return  # connection closed
+            self.parser.feed(data)
+
+class _Requests(object):
+    """
+    The requests to the SSR, subclasses define how `_request` sends them.
+    """
+
+    # ids and rounded values of the last set_src_poses call
+    _src_ids = None
+    _src_values = None
+
+    def _request(self, name, *args):
+        raise NotImplementedError
+
+    def _request_many(self, requests):
+        """Send (name, args) requests as a single request in a single write."""
+        raise NotImplementedError
+
+    def set_src_poses(self, ids, xy, azimuth=None):
+        """
+        Set positions in meters and optionally orientations in degrees of
+        many sources with a single request. Sources whose values did not
+        change since the last call, at the precision sent to the SSR, are
+        skipped.
+
+        Parameters
+        ----------
+        ids : array_like
+            Ids of N sources.
+        xy : array_like
+            N x 2 array of positions.
+        azimuth : array_like, optional
+            N orientations.
+
+        Returns
+        -------
+        count : int
+            Number of sources sent.
+        """
+        ids = np.asarray(ids, dtype=int).ravel()
+        values = np.asarray(xy, dtype=float).reshape(len(ids), 2)
+        if azimuth is not None:
+            values = np.column_stack((values, np.asarray(azimuth, dtype=float).ravel()))
+        values = np.round(values, self._encoder.precision)
+
+        last_ids, last_values = self._src_ids, self._src_values
+        if last_ids is None or last_values.shape[1] != values.shape[1]:
+            changed = np.ones(len(ids), dtype=bool)
+        elif np.array_equal(ids, last_ids):
+            changed = np.any(values != last_values, axis=1)
+        else:
+            # other sources than last time, compare those known
+            positions = dict(zip(last_ids.tolist(), range(len(last_ids))))
+            changed = np.ones(len(ids), dtype=bool)
+            for i, src_id in enumerate(ids.tolist()):
+                j = positions.get(src_id)
+                if j is not None:
+                    changed[i] = np.any(values[i] != last_values[j])
+        self._src_ids, self._src_values = ids, values
+
+        if not changed.any():
+            return 0
+        name = 'src_xy' if azimuth is None else 'src_pose'
+        requests = [(name, (src_id,) + tuple(row)) for src_id, row
+                    in zip(ids[changed].tolist(), values[changed].tolist())]
+        self._request_many(requests)
+        return len(requests)
 
     def src_creation(self, src_id):
         """
         Define a new source.
         """
-        new_src = '<request><source new="true" id="{0}" port="0"></source></request>'.format(src_id)+self._end_message
-        self._s.send(new_src.encode())
+        self._request('src_creation', src_id)
 
     def set_ref_position(self, x, y):
         """
         Set reference position in meters.
         """
-        ref_position = '<request><reference><position x="{0}" y="{1}"/></reference></request>'.format(x, y)+self._end_message
-        self._s.send(ref_position.encode())
+        self._request('ref_position', x, y)
 
     def set_ref_offset_position(self, x, y):
         """
         Set reference offset position in meters.
         """
-        ref_offset_position = '<request><reference_offset><position x="{0}" y="{1}"/></reference_offset></request>'.format(x, y)+self._end_message
-        self._s.send(ref_offset_position.encode())
+        self._request('ref_offset_position', x, y)
 
     def set_ref_orientation(self, alpha):
         """
         Set reference orientation in degrees (zero in positive x-direction).
         """
-        ref_orientation = '<request><reference><orientation azimuth="{0}"/></reference></request>'.format(alpha)+self._end_message
-        self._s.send(ref_orientation.encode())
+        self._request('ref_orientation', alpha)
 
     def set_ref_offset_orientation(self, alpha):
         """
         Set reference offset orientation in degrees (zero in positive x-direction).
         """
-        ref_offset_orientation = '<request><reference_offset><orientation azimuth="{0}"/></reference_offset></request>'.format(alpha)+self._end_message
-        self._s.send(ref_offset_orientation.encode())
+        self._request('ref_offset_orientation', alpha)
 
     def set_src_position(self, src_id, x, y):
         """
         Change name and position of an existing source.
         """
-        position = '<request><source id="{0}" name="SourceMotive{0}"><position x="{1:4.2f}" y="{2:4.2f}"/></source></request>'.format(src_id, x, y)+self._end_message
-        self._s.send(position.encode())
+        self._request('src_position', src_id, src_id, x, y)
 
     def set_src_orientation(self, src_id, alpha):
         """
         Change orientation of an existing source in degrees (zero in positive x-direction).
         """
-        orientation = '<request><source id="{0}"><orientation azimuth="{1}"/></source></request>'.format(src_id, alpha)+self._end_message
-        self._s.send(orientation.encode())
+        self._request('src_orientation', src_id, alpha)
 
     def load_scene(self, path):
         """
         Load a scene from a specified location on the machine running the SSR.
         """
-        scene = '<request><scene load="{0}"/></request>'.format(path)+self._end_message
-        self._s.send(scene.encode())
+        self._request('scene', path.encode())
 
     def set_transport_state(self, state):
         """
         Set a specific transport state, namely start, stop or rewind
         to play, pause or rewind all audio tracks of the loaded scene respectively.
         """
-        msg = '<request><state transport="{0}"/></request>'.format(state)+self._end_message
-        self._s.send(msg.encode())
+        self._request('transport_state', state.encode())
+
+class SSRClient(_Requests):
+    """
+    Establish a TCP/IP4 network connection and send XML messages
+    to communicate with a specific instance of the SoundScape Renderer.
+
+    Attributes
+    ----------
+    ip : str, optional
+        IP of the server running thr SSR. By default, it connects to localhost.
+    port : int, optional
+        Port of SSR Network Interface. By default, port = 4711.
+    end_message : str, optional
+        Symbol to terminate the XML messages send to SSR. By default, a binary zero.
+    batch : bool, optional
+        If True, the messages are queued and written with a single call
+        by `flush`. By default, every message is written immediately.
+    merge : bool, optional
+        If True, the messages queued in batch mode are merged into a single
+        request, such that the SSR applies them all at once.
+    precision : int, optional
+        Number of decimals of positions and angles sent to the SSR.
+    nonblocking : bool, optional
+        If True, the messages are written by a LatestValueWriter thread,
+        such that the setters never block if the SSR reads slowly; queued
+        positions and orientations are replaced by newer ones.
+    reader : bool, optional
+        If True, the messages returned by the SSR are read by a ResponseReader
+        thread, which mirrors the scene of the SSR in `scene`, and
+        `recv_ssr_returns` returns at once.
+    """
+
+    def __init__(self, ip='localhost', port=4711, end_message='\0', batch=False, merge=False,
+                 precision=4, nonblocking=False, reader=True):
+        self._ip = ip
+        self._port = port
+        self._end_message = end_message
+        self._batch = batch
+        self._merge = merge
+        self._encoder = MessageEncoder(precision, end_message)
+        # (name, args) of the queued requests
+        self._pending = []
+        # set before connecting, __del__ runs if the connection fails
+        self._writer = self._reader = None
+
+        # IP4 and TCP connection
+        self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._s.connect((self._ip, self._port))
+        # small messages are not held back to be coalesced by the kernel
+        self._s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if nonblocking:
+            self._writer = LatestValueWriter(self._s, self._encoder, merge)
+            self._writer.start()
+        if reader:
+            self._reader = ResponseReader(self._s, end_message)
+            self._reader.start()
+
+    def __del__(self):
+        if self._writer is not None:
+            self._writer.stop()
+        if self._reader is not None:
+            # wakes the reader thread, which close alone does not
+            try:
+                self._s.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self._s.close()
+        print("SSRClient: socket closed")
+
+    @property
+    def scene(self):
+        """SceneState mirroring the SSR, None without a reader."""
+        return None if self._reader is None else self._reader.scene
+
+    @property
+    def reader(self):
+        """ResponseReader, None if reader is False."""
+        return self._reader
+
+    def fileno(self):
+        """
+        Return the file descriptor of the socket, e.g. to wait for
+        returned messages with a selector.
+        """
+        return self._s.fileno()
+
+    @property
+    def writer(self):
+        """LatestValueWriter in nonblocking mode, otherwise None."""
+        return self._writer
+
+    def _request(self, name, *args):
+        """
+        Send a request, see MessageEncoder, or queue it in batch mode.
+        """
+        if self._writer is not None:
+            self._writer.put(name, args, wake=not self._batch)
+        elif self._batch:
+            self._pending.append((name, args))
+        else:
+            self._s.sendall(self._encoder.message(name, *args))
+
+    def _request_many(self, requests):
+        if self._writer is not None:
+            for name, args in requests[:-1]:
+                self._writer.put(name, args, wake=False)
+            name, args = requests[-1]
+            self._writer.put(name, args, wake=not self._batch)
+        elif self._batch:
+            self._pending.extend(requests)
+        else:
+            self._s.sendall(self._encoder.encode_many(requests, merge=True))
+
+    def flush(self):
+        """
+        Write all requests queued in batch mode with a single call.
+        """
+        if self._writer is not None:
+            self._writer.wake()
+            return
+        if not self._pending:
+            return
+        data = self._encoder.encode_many(self._pending, self._merge)
+        del self._pending[:]
+        self._s.sendall(data)
 
     def recv_ssr_returns(self):
         """
         Receive messages returned by the SSR.
+        With a reader thread, they are received already and this returns at once.
+
+        Returns
+        -------
+        connected : bool
+            False if the SSR closed the connection.
         """
-        msg = self._s.recv(65536)
+        if self._reader is not None:
+            return self._reader.is_alive()
+        return bool(self._s.recv(65536))
@@ -0,0 +1,262 @@
+"""
+A python module for controlling several instances of the SoundScape Renderer
+at once, e.g. one instance per loudspeaker array segment and per listener.
+
+Every request is encoded once and written to all instances by a single
+thread, which waits on all connections with one selector. The sockets do
+not block, such that an instance which reads slowly does not delay the
+others; its messages queue up until it can take them.
+
+This module requires Python 3.4 or newer.
+"""
+
+import collections
+import selectors
+import socket
+import threading
+from time import time
+
+from .ssr_client import _Requests, MessageEncoder, ResponseParser
+
+
+class SSRConnection(object):
+    """
+    Connection of an SSRGroup to one instance of the SSR.
+
+    Attributes
+    ----------
+    address : tuple
+        IP and port of the SSR instance.
+    scene : SceneState
+        Mirror of the scene of the SSR instance.
+    latencies : deque
+        Seconds from queuing to the complete write of the last writes,
+        measured for the oldest message of every write.
+    dropped : int
+        Number of messages dropped because the queue was full.
+    closed : bool
+        Whether the connection was closed, by the SSR or after an error.
+    error : OSError
+        Error which closed the connection, otherwise None.
+    """
+
+    def __init__(self, address, end_message, max_queue):
+        self.address = address
+        self.sock = socket.create_connection(address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(False)
+        self.parser = ResponseParser(end_message)
+        self.latencies = collections.deque(maxlen=1000)
+        self.dropped = 0
+        self.error = None
+        self.closed = False
+        # (message, time queued) waiting to be written
+        self._queue = collections.deque()
+        self._max_queue = max_queue
+        # data being written and time its oldest message was queued
+        self._current = None
+        self._current_since = None
+
+    @property
+    def scene(self):
+        return self.parser.scene
+
+    @property
+    def pending(self):
+        """Whether messages wait to be written."""
+        return self._current is not None or bool(self._queue)
+
+    def put(self, msg, now):
+        if self.closed:
+            return
+        if len(self._queue) >= self._max_queue:
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append((msg, now))
+
+    def close(self):
+        """Close the connection and drop the queued messages."""
+        self.closed = True
+        self._queue.clear()
+        self._current = None
+        self.sock.close()
+
+    def write(self):
+        """
+        Write as much as the socket takes without blocking.
+        Return False if the connection failed.
+        """
+        if self._current is None:
+            # all queued messages are written at once
+            self._current_since = self._queue[0][1]
+            self._current = memoryview(b''.join([msg for msg, _ in self._queue]))
+            self._queue.clear()
+        try:
+            sent = self.sock.send(self._current)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError as error:
+            self.error = error
+            return False
+        self._current = self._current[sent:]
+        if not len(self._current):
+            self.latencies.append(time() - self._current_since)
+            self._current = None
+        return True
+
+    def read(self):
+        """
+        Read and parse the messages returned by the SSR instance.
+        Return False if the connection was closed or failed.
+        """
+        try:
+            data = self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError as error:
+            self.error = error
+            return False
+        if not data:
+            return False  # closed by the SSR
+        self.parser.feed(data)
+        return True
+
+
+class SSRGroup(_Requests):
+    """
+    Send the same requests to several instances of the SSR.
+
+    It offers the setters of SSRClient, e.g. set_ref_orientation, which
+    queue the encoded request for every instance and return at once.
+
+    Attributes
+    ----------
+    addresses : list
+        (ip, port) tuples of the SSR instances.
+    end_message : str, optional
+        Symbol to terminate the XML messages send to SSR. By default, a binary zero.
+    batch : bool, optional
+        If True, the messages are queued until `flush`.
+    merge : bool, optional
+        If True, the messages queued in batch mode are merged into a single request.
+    precision : int, optional
+        Number of decimals of positions and angles sent to the SSR.
+    max_queue : int, optional
+        Maximum number of messages waiting for an instance, older ones are dropped.
+    """
+
+    def __init__(self, addresses, end_message='\0', batch=False, merge=False,
+                 precision=4, max_queue=1000):
+        self._encoder = MessageEncoder(precision, end_message)
+        self._batch = batch
+        self._merge = merge
+        self._pending = []
+        self._connections = [SSRConnection(tuple(address), end_message, max_queue)
+                             for address in addresses]
+        self._lock = threading.Lock()
+        # wakes the selector when messages are queued
+        self._wake_recv, self._wake_send = socket.socketpair()
+        self._wake_recv.setblocking(False)
+        self._wake_send.setblocking(False)
+        self._quit = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def connections(self):
+        """SSRConnection objects of the instances."""
+        return list(self._connections)
+
+    def close(self):
+        """Stop the thread and close all connections."""
+        self._quit = True
+        self._wake()
+        self._thread.join()
+        for connection in self._connections:
+            connection.sock.close()
+        self._wake_recv.close()
+        self._wake_send.close()
+
+    def _request(self, name, *args):
+        if self._batch:
+            self._pending.append((name, args))
+        else:
+            self._put(self._encoder.message(name, *args))
+
+    def _request_many(self, requests):
+        if self._batch:
+            self._pending.extend(requests)
+        else:
+            self._put(self._encoder.encode_many(requests, merge=True))
+
+    def flush(self):
+        """
+        Queue all requests of batch mode as one write.
+        """
+        if not self._pending:
+            return
+        data = self._encoder.encode_many(self._pending, self._merge)
+        del self._pending[:]
+        self._put(data)
+
+    def recv_ssr_returns(self):
+        """
+        The messages returned by the SSR instances are read by the thread
+        of the group, this returns at once.
+        """
+        return
+
+    def _put(self, msg):
+        now = time()
+        with self._lock:
+            for connection in self._connections:
+                connection.put(msg, now)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_send.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass  # the selector is woken already
+
+    def _drop(self, selector, connection):
+        selector.unregister(connection.sock)
+        with self._lock:
+            connection.close()
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._wake_recv, selectors.EVENT_READ)
+        for connection in self._connections:
+            selector.register(connection.sock, selectors.EVENT_READ, connection)
+        while not self._quit:
+            for key, events in selector.select():
+                connection = key.data
+                if connection is None:
+                    try:
+                        self._wake_recv.recv(4096)
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    continue
+                # a failed connection is closed, the others are served on
+                if events & selectors.EVENT_READ and not connection.read():
+                    self._drop(selector, connection)
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    with self._lock:
+                        ok = connection.write()
+                    if not ok:
+                        self._drop(selector, connection)
+            # only connections with queued messages wait for writability
+            with self._lock:
+                for connection in self._connections:
+                    if connection.closed:
+                        continue
+                    key = selector.get_key(connection.sock)
+                    events = selectors.EVENT_READ
+                    if connection.pending:
+                        events |= selectors.EVENT_WRITE
+                    if key.events != events:
+                        selector.modify(connection.sock, events, connection)
+        selector.close()
@@ -0,0 +1,71 @@
+"""
+A python module for measuring the CPU cost of encoding the messages
+sent to the SSR, without a connection to the SSR.
+
+The string formatting of previous versions of SSRClient is compared
+with the precompiled byte templates of MessageEncoder, per message and
+for the bulk encoding of the updates of many sources at once.
+
+Usage: python opti_ssr_benchmark_messages.py [number of messages] [precision]
+"""
+
+from __future__ import print_function
+import sys
+import timeit
+from opti_ssr.ssr_client import MessageEncoder
+
+
+def format_ref_position(x, y, end_message='\0'):
+    """Encode a reference position as SSRClient did before MessageEncoder."""
+    msg = '<request><reference><position x="{0}" y="{1}"/></reference></request>'.format(x, y)+end_message
+    return msg.encode()
+
+
+def format_src_position(src_id, x, y, end_message='\0'):
+    """Encode a source position as SSRClient did before MessageEncoder."""
+    msg = '<request><source id="{0}" name="SourceMotive{0}"><position x="{1:4.2f}" y="{2:4.2f}"/></source></request>'.format(src_id, x, y)+end_message
+    return msg.encode()
+
+
+def benchmark(num=100000, precision=4, sources=32):
+    """ A benchmark function printing the time per encoded message.
+
+    Parameters
+    ----------
+    num : int, optional
+        Number of messages to encode per measurement.
+    precision : int, optional
+        Number of decimals of the floats.
+    sources : int, optional
+        Number of source positions encoded at once by the bulk encoder.
+    """
+    # setting arguments if executed in command line
+    if sys.argv[1:]:
+        num = int(sys.argv[1])
+    if sys.argv[2:]:
+        precision = int(sys.argv[2])
+
+    encoder = MessageEncoder(precision)
+    x, y = 1.2345678, -0.25
+    requests = [('src_position', (i, i, x, y)) for i in range(sources)]
+
+    results = [
+        ("str.format ref_position", lambda: format_ref_position(x, y), num),
+        ("template ref_position", lambda: encoder.message('ref_position', x, y), num),
+        ("str.format src_position", lambda: format_src_position(7, x, y), num),
+        ("template src_position", lambda: encoder.message('src_position', 7, 7, x, y), num),
+        ("str.format {0} sources".format(sources),
+         lambda: b''.join([format_src_position(i, x, y) for i in range(sources)]),
+         num // sources),
+        ("encode_many {0} sources".format(sources),
+         lambda: encoder.encode_many(requests), num // sources),
+        ("encode_many {0} sources merged".format(sources),
+         lambda: encoder.encode_many(requests, merge=True), num // sources),
+    ]
+    for name, func, number in results:
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        per_message = seconds / (number * (sources if "sources" in name else 1))
+        print("{0:34s} {1:8.3f} us per message".format(name, per_message * 1e6))
+
+if __name__ == "__main__":
+    benchmark()